@@ -1,8 +1,14 @@
 import io
+import time
+import uuid
 import base64
+import threading
 import music21 as m21
 from music21 import converter, stream, note, metadata
-from dash import Dash, html, dcc, callback, Output, Input, State
+from dash import Dash, html, dcc, callback, Output, Input, State, no_update
+
+from configurations import GENERATION_TTL, MAX_GENERATIONS, ENCODING, ENCODING_SETTINGS
+
 
 # """
 app = Dash("Music Generation Project")
@@ -34,6 +40,22 @@ app.layout = html.Div(
 
                     ),
                     html.Div(id='output-data-upload'),
+                    html.H3(children='Generate a melody'),
+                    dcc.Input(id='seed-input', type='text', value=ENCODING_SETTINGS[ENCODING]['seed'], style={'width': '100%'}),
+                    html.Div([
+                        'Steps ',
+                        dcc.Input(id='steps-input', type='number', value=500, min=1),
+                        ' Temperature ',
+                        dcc.Input(id='temperature-input', type='number', value=0.8, min=0.1, step=0.05),
+                    ], style={'margin': '10px 0'}),
+                    html.Button('Generate', id='generate-button'),
+                    html.Button('Stop', id='stop-button'),
+                    html.Button('Download MIDI', id='download-button'),
+                    dcc.Download(id='melody-download'),
+                    dcc.Store(id='generation-id'),
+                    dcc.Interval(id='generation-interval', interval=500),
+                    html.Div(id='generation-status'),
+                    html.Pre(id='generation-output', style={'whiteSpace': 'pre-wrap'}),
                 ], style={'margin':'auto'})
     ], style={ 
         'marginTop':'1%',
@@ -112,6 +134,169 @@ def update_output(contents, filename):
 
 
 
+# running and finished generations, shared between the callbacks of this process
+_generations = {}
+_generations_lock = threading.Lock()
+_melody_generator = None
+_melody_generator_lock = threading.Lock()
+
+
+def get_melody_generator():
+    # the generator imports keras, so it is only loaded when a melody is requested
+    global _melody_generator
+    with _melody_generator_lock:
+        if _melody_generator is None:
+            from melody_generator import MelodyGenerator
+            _melody_generator = MelodyGenerator()
+    return _melody_generator
+
+
+def run_generation(generation, melody_generator, seed, num_steps, temperature):
+    try:
+        for symbol in melody_generator.stream_melody(seed, num_steps, melody_generator.sequence_length, temperature,
+                                                     cancel_event=generation["cancel"]):
+            generation["symbols"].append(symbol)
+    except Exception as error:
+        generation["error"] = str(error)
+    finally:
+        generation["finished_at"] = time.monotonic()
+        generation["done"] = True
+
+
+def evict_generations():
+    # forget generations that finished more than GENERATION_TTL seconds ago,
+    # then stop and forget the oldest ones beyond MAX_GENERATIONS
+    now = time.monotonic()
+    with _generations_lock:
+        for generation_id, generation in list(_generations.items()):
+            if generation["done"] and now - generation["finished_at"] > GENERATION_TTL:
+                del _generations[generation_id]
+        oldest_first = sorted(_generations, key=lambda generation_id: _generations[generation_id]["started_at"])
+        evicted = [_generations.pop(generation_id) for generation_id in oldest_first[:-MAX_GENERATIONS]]
+    for generation in evicted:
+        generation["cancel"].set()
+
+
+def parse_generation_inputs(seed, num_steps, temperature, mapping):
+    # the inputs are empty or None while the user is editing them
+    if not seed or not seed.split():
+        raise ValueError("Enter a seed melody.")
+    # the delimiter is in the mapping but cannot be rendered as a note
+    unknown = [symbol for symbol in seed.split() if symbol not in mapping or symbol == "/"]
+    if unknown:
+        raise ValueError(f"Unknown seed symbols for the {ENCODING} encoding: {' '.join(unknown)}")
+    if num_steps is None or int(num_steps) < 1:
+        raise ValueError("Enter a number of steps of at least 1.")
+    if temperature is None or float(temperature) <= 0:
+        raise ValueError("Enter a temperature above 0.")
+    return seed, int(num_steps), float(temperature)
+
+
+@callback(
+        Output('generation-id', 'data'),
+        Output('generation-status', 'children', allow_duplicate=True),
+        Input('generate-button', 'n_clicks'),
+        State('seed-input', 'value'),
+        State('steps-input', 'value'),
+        State('temperature-input', 'value'),
+        State('generation-id', 'data'),
+        prevent_initial_call=True,
+        )
+def start_generation(n_clicks, seed, num_steps, temperature, previous_id):
+    try:
+        melody_generator = get_melody_generator()
+        mapping = melody_generator.mapping
+    except Exception as error:
+        return no_update, f"Could not load the model: {error}"
+    try:
+        seed, num_steps, temperature = parse_generation_inputs(seed, num_steps, temperature, mapping)
+    except ValueError as error:
+        return no_update, str(error)
+
+    # a new generation replaces the previous one of this page
+    with _generations_lock:
+        previous = _generations.pop(previous_id, None)
+    if previous is not None:
+        previous["cancel"].set()
+    evict_generations()
+
+    generation = {
+        "seed": seed.split(),
+        "symbols": [],
+        "done": False,
+        "error": None,
+        "cancel": threading.Event(),
+        "started_at": time.monotonic(),
+        "finished_at": None,
+    }
+    generation_id = str(uuid.uuid4())
+    with _generations_lock:
+        _generations[generation_id] = generation
+
+    threading.Thread(
+        target=run_generation, args=(generation, melody_generator, seed, num_steps, temperature), daemon=True
+    ).start()
+    return generation_id, ""
+
+
+@callback(
+        Output('generation-status', 'children'),
+        Input('stop-button', 'n_clicks'),
+        State('generation-id', 'data'),
+        prevent_initial_call=True,
+        )
+def stop_generation(n_clicks, generation_id):
+    generation = _generations.get(generation_id)
+    if generation is None:
+        return no_update
+    generation["cancel"].set()
+    return "Generation stopped."
+
+
+@callback(
+        Output('generation-output', 'children'),
+        Input('generation-interval', 'n_intervals'),
+        State('generation-id', 'data'),
+        )
+def render_generation(n_intervals, generation_id):
+    evict_generations()
+    generation = _generations.get(generation_id)
+    if generation is None:
+        return no_update
+
+    from melody_generator import melody_to_note_events
+    # copy the list, the generation thread keeps appending to it
+    symbols = generation["seed"] + list(generation["symbols"])
+    events = melody_to_note_events(symbols, encoding=ENCODING)
+    notes = " ".join(f"{symbol}:{quarter_length:g}" for symbol, quarter_length in events)
+
+    if generation["error"] is not None:
+        state = f"Generation failed: {generation['error']}"
+    elif generation["done"]:
+        state = f"Finished after {len(generation['symbols'])} steps."
+    else:
+        state = f"Generating... {len(generation['symbols'])} steps so far."
+    return f"{state}\n\nSymbols: {' '.join(symbols)}\n\nNotes (pitch:quarter length): {notes}"
+
+
+@callback(
+        Output('melody-download', 'data'),
+        Input('download-button', 'n_clicks'),
+        State('generation-id', 'data'),
+        prevent_initial_call=True,
+        )
+def download_melody(n_clicks, generation_id):
+    generation = _generations.get(generation_id)
+    if generation is None:
+        return no_update
+
+    from melody_generator import melody_to_midi_bytes
+    # the partial melody can be downloaded and played while generation continues
+    symbols = generation["seed"] + list(generation["symbols"])
+    content = melody_to_midi_bytes(symbols, encoding=ENCODING)
+    return dcc.send_bytes(content, "melody.mid")
+
+
 if __name__ == '__main__':
     app.run(debug=True)
     # with open('D:\Python Projects\Melody Generation\Melodies\misc\Bella_ciao.musicxml', 'rb') as file:
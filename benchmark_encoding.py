@@ -0,0 +1,148 @@
+import os
+os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
+
+import time
+import argparse
+
+import numpy as np
+import keras
+
+from configurations import ACCEPTABLE_DURATIONS, \
+    NUM_UNITS, \
+    LOSS, \
+    LEARNING_RATE, \
+    BATCH_SIZE, \
+    DELIMETER, \
+    ENCODING_SETTINGS
+from preprocess import load_songs_in_kern, has_acceptable_duration, transpose, encode
+from train import build_model
+
+
+def encode_collection(dataset_path):
+    """
+    Encodes every acceptable song of a collection with both encodings.
+
+    Parameters
+    ----------
+    dataset_path : str
+        The path to the collection.
+
+    Returns
+    -------
+    dict
+        For every encoding, the list of encoded songs as lists of symbols.
+    """
+    encoded_songs = {encoding: [] for encoding in ENCODING_SETTINGS}
+    for song in load_songs_in_kern(dataset_path):
+        if not has_acceptable_duration(song, ACCEPTABLE_DURATIONS):
+            continue
+        transposed_song = transpose(song)
+        for encoding in ENCODING_SETTINGS:
+            encoded_songs[encoding].append(encode(transposed_song, encoding=encoding).split())
+    return encoded_songs
+
+
+def build_training_windows(songs, sequence_length):
+    """
+    Builds the one-hot training windows of the concatenated single file
+    dataset in memory, like `generate_training_sequences`.
+
+    Returns
+    -------
+    inputs : numpy.ndarray
+        The one-hot input windows.
+    targets : numpy.ndarray
+        The target symbol indices.
+    vocabulary_size : int
+        The number of symbols including the delimiter.
+    """
+    delimiter = DELIMETER.strip()
+    symbols = []
+    for song in songs:
+        symbols += song + [delimiter] * sequence_length
+
+    mapping = {symbol: index for index, symbol in enumerate(sorted(set(symbols)))}
+    numeric_songs = np.array([mapping[symbol] for symbol in symbols], dtype=np.int32)
+
+    windows = np.lib.stride_tricks.sliding_window_view(numeric_songs[:-1], sequence_length)
+    inputs = keras.utils.to_categorical(windows, num_classes=len(mapping)).astype(np.int8)
+    targets = numeric_songs[sequence_length:]
+    return inputs, targets, len(mapping)
+
+
+def time_generation(model, vocabulary_size, sequence_length, num_steps):
+    """
+    Measures the time of num_steps single-window forward passes, the cost of
+    generating a melody of num_steps symbols.
+    """
+    window = np.zeros((1, sequence_length, vocabulary_size), dtype=np.float32)
+    window[0, :, 0] = 1
+    model(window, training=False)
+
+    start_time = time.perf_counter()
+    for _ in range(num_steps):
+        model(window, training=False)
+    return time.perf_counter() - start_time
+
+
+def benchmark(dataset_path):
+    """
+    Compares the time series and the event encoding on a collection: symbols
+    per song, training windows, the time of one training epoch, and the
+    latency of generating a melody of average song length.
+
+    The models are untrained, as the cost of an epoch or a generation step
+    does not depend on the weights.
+
+    Parameters
+    ----------
+    dataset_path : str
+        The path to the collection.
+
+    Returns
+    -------
+    dict
+        The measurements of every encoding.
+    """
+    encoded_songs = encode_collection(dataset_path)
+    print(f"Encoded {len(encoded_songs['time_series'])} songs.")
+
+    results = {}
+    for encoding, songs in encoded_songs.items():
+        sequence_length = ENCODING_SETTINGS[encoding]["sequence_length"]
+        symbols_per_song = float(np.mean([len(song) for song in songs]))
+        inputs, targets, vocabulary_size = build_training_windows(songs, sequence_length)
+
+        model = build_model(vocabulary_size, NUM_UNITS, LOSS, LEARNING_RATE)
+        # the first epoch includes graph tracing, so time the second one
+        model.fit(inputs, targets, epochs=1, batch_size=BATCH_SIZE, verbose=0)
+        start_time = time.perf_counter()
+        model.fit(inputs, targets, epochs=1, batch_size=BATCH_SIZE, verbose=0)
+        epoch_seconds = time.perf_counter() - start_time
+
+        generation_seconds = time_generation(model, vocabulary_size, sequence_length, round(symbols_per_song))
+
+        results[encoding] = {
+            "symbols_per_song": symbols_per_song,
+            "vocabulary_size": vocabulary_size,
+            "windows": len(targets),
+            "epoch_seconds": epoch_seconds,
+            "generation_seconds": generation_seconds,
+        }
+
+    print(f"{'':>20}" + "".join(f"{encoding:>14}" for encoding in results))
+    for metric in ("symbols_per_song", "vocabulary_size", "windows", "epoch_seconds", "generation_seconds"):
+        print(f"{metric:>20}" + "".join(f"{values[metric]:>14.3f}" for values in results.values()))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the time series and the event encoding.")
+    parser.add_argument("dataset", nargs="?", default="Melodies/deutschl/kinder", help="collection to benchmark on")
+    args = parser.parse_args()
+    benchmark(args.dataset)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import os
+import json
+import zlib
+import zipfile
+import argparse
+import itertools
+import multiprocessing
+
+from configurations import BULK_SHARD_SIZE, BULK_BATCH_SIZE, ENCODING, ENCODING_SETTINGS
+
+MANIFEST_FILE = "manifest.jsonl"
+CONFIG_FILE = "config.json"
+
+# set by _init_worker in every worker process
+_melody_generator = None
+
+
+def load_seeds(seeds_file_path):
+    """
+    Reads one seed per non-empty line of a text file.
+
+    Parameters
+    ----------
+    seeds_file_path : str
+        The path to the seeds file.
+
+    Returns
+    -------
+    list of str
+        The seeds.
+    """
+    with open(seeds_file_path, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def create_jobs(seeds, temperatures, num_steps, repeats):
+    """
+    Expands the seeds and the parameter grid into one job per melody.
+
+    The order only depends on the arguments, so an interrupted run can be
+    resumed with the same shards.
+
+    Parameters
+    ----------
+    seeds : list of str
+        The seeds.
+    temperatures : list of float
+        The sampling temperatures of the grid.
+    num_steps : list of int
+        The numbers of steps of the grid.
+    repeats : int
+        The number of melodies per seed and grid point.
+
+    Returns
+    -------
+    list of dict
+        The jobs, each with an "id", "seed", "temperature" and "num_steps".
+    """
+    jobs = []
+    for (seed_index, seed), temperature, steps, repeat in itertools.product(
+            enumerate(seeds), temperatures, num_steps, range(repeats)):
+        jobs.append({
+            "id": f"s{seed_index:05d}-t{temperature:g}-n{steps}-r{repeat:03d}",
+            "seed": seed,
+            "temperature": temperature,
+            "num_steps": steps,
+        })
+    return jobs
+
+
+def _init_worker(model_path, mapping_path, encoding, threads):
+    """
+    Pins the thread pools of the worker before TensorFlow is imported and
+    loads the model once for all shards of this worker.
+    """
+    global _melody_generator
+
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    from melody_generator import MelodyGenerator
+    _melody_generator = MelodyGenerator(model_path=model_path, mapping_path=mapping_path, encoding=encoding)
+
+
+def _generate_shard(task):
+    """
+    Generates all melodies of one shard and writes them as MIDI files into a
+    zip archive, together with the manifest entries of the shard.
+
+    The archive is written under a temporary name and renamed when complete,
+    so an existing shard archive is always complete.
+    """
+    import numpy as np
+    from melody_generator import melody_to_midi_bytes
+
+    shard_name, jobs, output_dir, max_sequence_length, batch_size = task
+    # a fixed random state per shard keeps resumed runs reproducible
+    np.random.seed(zlib.crc32(shard_name.encode()))
+
+    entries = []
+    shard_path = os.path.join(output_dir, shard_name)
+    temporary_path = shard_path + ".partial"
+    with zipfile.ZipFile(temporary_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for start in range(0, len(jobs), batch_size):
+            batch = jobs[start:start + batch_size]
+            melodies = _melody_generator.generate_melodies(
+                [job["seed"] for job in batch],
+                [job["num_steps"] for job in batch],
+                max_sequence_length,
+                [job["temperature"] for job in batch],
+            )
+            for job, melody in zip(batch, melodies):
+                file_name = f"{job['id']}.mid"
+                archive.writestr(file_name, melody_to_midi_bytes(melody, encoding=_melody_generator.encoding))
+                entries.append(dict(job, shard=shard_name, file=file_name, melody=" ".join(melody)))
+
+        archive.writestr(MANIFEST_FILE, "".join(json.dumps(entry) + "\n" for entry in entries))
+    os.replace(temporary_path, shard_path)
+
+    return shard_name, entries
+
+
+def _recover_manifest(output_dir, shards):
+    """
+    Repairs the manifest after an interruption and returns the names of the
+    shards it covers completely.
+
+    Cut-off lines and the entries of shards that were only partly added are
+    dropped, and the entries of complete shard archives that are missing from
+    the manifest are added from the archives.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    entries = {}
+    lines = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as manifest:
+            lines = manifest.readlines()
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        entries.setdefault(entry["shard"], []).append(line if line.endswith("\n") else line + "\n")
+
+    recorded = {name for name, shard_lines in entries.items() if len(shard_lines) == len(shards.get(name, ()))}
+    for shard_name in shards:
+        shard_path = os.path.join(output_dir, shard_name)
+        if shard_name not in recorded and os.path.exists(shard_path):
+            with zipfile.ZipFile(shard_path) as archive:
+                entries[shard_name] = archive.read(MANIFEST_FILE).decode().splitlines(keepends=True)
+            recorded.add(shard_name)
+
+    # write the repaired manifest next to the old one and swap them
+    temporary_path = manifest_path + ".partial"
+    with open(temporary_path, "w") as manifest:
+        for shard_name in sorted(recorded):
+            manifest.writelines(entries[shard_name])
+    os.replace(temporary_path, manifest_path)
+
+    return recorded
+
+
+def bulk_generate(seeds, output_dir, temperatures, num_steps, repeats=1, workers=None, threads_per_worker=1,
+                  model_path=None, mapping_path=None, max_sequence_length=None,
+                  shard_size=BULK_SHARD_SIZE, batch_size=BULK_BATCH_SIZE, encoding=ENCODING):
+    """
+    Generates melodies for every seed and grid point with a pool of worker
+    processes and writes them to sharded zip archives of MIDI files plus a
+    JSONL manifest in output_dir.
+
+    Running it again with the same arguments skips the shards that are
+    already complete, so an interrupted run can be resumed.
+
+    Parameters
+    ----------
+    seeds : list of str
+        The seeds.
+    output_dir : str
+        The directory of the shards and the manifest.
+    temperatures : list of float
+        The sampling temperatures of the grid.
+    num_steps : list of int
+        The numbers of steps of the grid.
+    repeats : int, optional
+        The number of melodies per seed and grid point.
+    workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs
+        divided by threads_per_worker.
+    threads_per_worker : int, optional
+        The number of TensorFlow threads of each worker.
+    model_path : str, optional
+        The path to the model. Defaults to the model of the encoding.
+    mapping_path : str, optional
+        The path to the mapping of symbols to indices. Defaults to the
+        mapping of the encoding.
+    max_sequence_length : int, optional
+        The maximum length of the sequence fed to the model. Defaults to the
+        window length of the encoding.
+    shard_size : int, optional
+        The number of melodies per shard archive.
+    batch_size : int, optional
+        The number of melodies a worker generates together.
+    encoding : str, optional
+        "time_series" or "event", the encoding of the model and the seeds.
+
+    Returns
+    -------
+    int
+        The number of shards generated by this run.
+    """
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    settings = ENCODING_SETTINGS[encoding]
+    model_path = model_path if model_path is not None else settings["model_path"]
+    mapping_path = mapping_path if mapping_path is not None else settings["mapping_path"]
+    if max_sequence_length is None:
+        max_sequence_length = settings["sequence_length"]
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # resuming with other settings would mix melodies of different grids
+    config = {
+        "seeds": seeds,
+        "temperatures": temperatures,
+        "num_steps": num_steps,
+        "repeats": repeats,
+        "model_path": model_path,
+        "mapping_path": mapping_path,
+        "encoding": encoding,
+        "max_sequence_length": max_sequence_length,
+        "shard_size": shard_size,
+        # the batches consume the random state of a shard in a different order
+        "batch_size": batch_size,
+    }
+    config_path = os.path.join(output_dir, CONFIG_FILE)
+    if os.path.exists(config_path):
+        with open(config_path, "r") as file:
+            if json.load(file) != config:
+                raise ValueError(f"{output_dir} contains a run with different settings.")
+    else:
+        with open(config_path, "w") as file:
+            json.dump(config, file, indent=4)
+
+    jobs = create_jobs(seeds, temperatures, num_steps, repeats)
+    shards = {
+        f"shard-{index:05d}.zip": jobs[start:start + shard_size]
+        for index, start in enumerate(range(0, len(jobs), shard_size))
+    }
+    done = _recover_manifest(output_dir, shards)
+    tasks = [
+        (shard_name, shard_jobs, output_dir, max_sequence_length, batch_size)
+        for shard_name, shard_jobs in shards.items() if shard_name not in done
+    ]
+    print(f"{len(jobs)} melodies in {len(shards)} shards, {len(shards) - len(tasks)} shards already done.")
+    if not tasks:
+        return 0
+
+    # spawn, so that every worker imports TensorFlow after pinning its threads
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(min(workers, len(tasks)), initializer=_init_worker,
+                      initargs=(model_path, mapping_path, encoding, threads_per_worker)) as pool, \
+            open(os.path.join(output_dir, MANIFEST_FILE), "a") as manifest:
+        for completed, (shard_name, entries) in enumerate(pool.imap_unordered(_generate_shard, tasks), start=1):
+            manifest.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            manifest.flush()
+            print(f"Finished {shard_name} ({completed}/{len(tasks)}).")
+
+    return len(tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate melodies in bulk with several worker processes.")
+    parser.add_argument("seeds_file", help="text file with one seed per line")
+    parser.add_argument("output_dir", help="directory of the shard archives and the manifest")
+    parser.add_argument("--temperatures", type=float, nargs="+", default=[0.8])
+    parser.add_argument("--num-steps", type=int, nargs="+", default=[500])
+    parser.add_argument("--repeats", type=int, default=1, help="melodies per seed and grid point")
+    parser.add_argument("--workers", type=int, help="number of worker processes")
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    parser.add_argument("--model", help="defaults to the model of the encoding")
+    parser.add_argument("--mapping", help="defaults to the mapping of the encoding")
+    parser.add_argument("--encoding", choices=sorted(ENCODING_SETTINGS), default=ENCODING)
+    parser.add_argument("--shard-size", type=int, default=BULK_SHARD_SIZE)
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    args = parser.parse_args()
+
+    bulk_generate(
+        load_seeds(args.seeds_file),
+        args.output_dir,
+        args.temperatures,
+        args.num_steps,
+        repeats=args.repeats,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        model_path=args.model,
+        mapping_path=args.mapping,
+        shard_size=args.shard_size,
+        batch_size=args.batch_size,
+        encoding=args.encoding,
+    )
+
+
+if __name__ == "__main__":
+    main()
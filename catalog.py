@@ -0,0 +1,325 @@
+import os
+import json
+import sqlite3
+import hashlib
+import argparse
+
+import music21 as m21
+
+from configurations import ACCEPTABLE_DURATIONS, \
+    KERN_DATASET_PATH, \
+    TEST_DATASET_PATH, \
+    CATALOG_PATH, \
+    ENCODING, \
+    ENCODING_SETTINGS
+from preprocess import has_acceptable_duration, preprocess, is_inside
+
+
+SONG_EXTENSIONS = ("krn", "musicxml")
+
+CREATE_SONGS_TABLE = """
+CREATE TABLE IF NOT EXISTS songs (
+    file_path TEXT PRIMARY KEY,
+    collection TEXT NOT NULL,
+    meter TEXT,
+    key TEXT,
+    key_source TEXT,
+    note_count INTEGER NOT NULL,
+    durations TEXT NOT NULL,
+    acceptable_duration INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+)
+"""
+
+CREATE_COLLECTION_INDEX = "CREATE INDEX IF NOT EXISTS songs_collection ON songs (collection)"
+
+
+def connect_catalog(catalog_path):
+    """
+    Opens the catalog database, creating the schema if it does not exist yet.
+
+    Parameters
+    ----------
+    catalog_path : str
+        The path to the SQLite catalog file.
+
+    Returns
+    -------
+    sqlite3.Connection
+        An open connection to the catalog.
+    """
+    connection = sqlite3.connect(catalog_path)
+    connection.execute(CREATE_SONGS_TABLE)
+    connection.execute(CREATE_COLLECTION_INDEX)
+    return connection
+
+
+def hash_file(file_path):
+    """
+    Computes the SHA-256 hash of a file's content.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the file.
+
+    Returns
+    -------
+    str
+        The hexadecimal digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_key(song):
+    """
+    Finds the key of a song, preferring the notated key over an analyzed one.
+
+    Parameters
+    ----------
+    song : music21.stream.Score
+        The song to inspect.
+
+    Returns
+    -------
+    key : str
+        The key of the song, e.g. "F major".
+    key_source : str
+        "signature" if the key was notated in the score, "analyzed" otherwise.
+    """
+    for key in song.flatten().getElementsByClass(m21.key.Key):
+        return f"{key.tonic.name} {key.mode}", "signature"
+
+    key = song.analyze("key")
+    return f"{key.tonic.name} {key.mode}", "analyzed"
+
+
+def extract_metadata(song, file_path, acceptable_durations):
+    """
+    Extracts the catalog record of a parsed song.
+
+    Parameters
+    ----------
+    song : music21.stream.Score
+        The parsed song.
+    file_path : str
+        The path of the file the song was parsed from.
+    acceptable_durations : list of float
+        A list of acceptable durations.
+
+    Returns
+    -------
+    dict
+        The catalog record for the song.
+    """
+    flat_song = song.flatten()
+
+    time_signatures = flat_song.getElementsByClass(m21.meter.TimeSignature)
+    meter = time_signatures[0].ratioString if time_signatures else None
+
+    key, key_source = extract_key(song)
+
+    notes_and_rests = flat_song.notesAndRests
+    note_count = sum(1 for event in notes_and_rests if isinstance(event, m21.note.Note))
+    durations = sorted({float(event.duration.quarterLength) for event in notes_and_rests})
+
+    return {
+        "file_path": file_path,
+        "collection": os.path.dirname(file_path),
+        "meter": meter,
+        "key": key,
+        "key_source": key_source,
+        "note_count": note_count,
+        "durations": json.dumps(durations),
+        "acceptable_duration": int(has_acceptable_duration(song, acceptable_durations)),
+    }
+
+
+def build_catalog(dataset_path, catalog_path, acceptable_durations=ACCEPTABLE_DURATIONS,
+                  exclude_paths=(TEST_DATASET_PATH,)):
+    """
+    Walks through the dataset and records the metadata of every song in the
+    catalog.
+
+    Files whose content hash is already in the catalog are not parsed again,
+    so rebuilding the catalog only costs a music21 parse for new or changed
+    files. Entries of files that no longer exist under dataset_path are
+    removed.
+
+    Parameters
+    ----------
+    dataset_path : str
+        The path to the root directory of the dataset.
+    catalog_path : str
+        The path to the SQLite catalog file.
+    acceptable_durations : list of float, optional
+        A list of acceptable durations. Defaults to ACCEPTABLE_DURATIONS.
+    exclude_paths : iterable of str, optional
+        Directories that are not cataloged. Defaults to the held-out
+        TEST_DATASET_PATH, so test songs can never be selected for training.
+
+    Returns
+    -------
+    dict
+        The number of "parsed", "unchanged", "failed" and "removed" files.
+    """
+    stats = {"parsed": 0, "unchanged": 0, "failed": 0, "removed": 0}
+
+    connection = connect_catalog(catalog_path)
+    known_hashes = dict(connection.execute("SELECT file_path, content_hash FROM songs"))
+
+    seen_paths = set()
+    for path, subdirs, files in os.walk(dataset_path):
+        subdirs[:] = [subdir for subdir in subdirs if not is_inside(os.path.join(path, subdir), exclude_paths)]
+        for file in files:
+            if file.split(".")[-1] not in SONG_EXTENSIONS:
+                continue
+            file_path = os.path.normpath(os.path.join(path, file))
+            seen_paths.add(file_path)
+
+            content_hash = hash_file(file_path)
+            if known_hashes.get(file_path) == content_hash:
+                stats["unchanged"] += 1
+                continue
+
+            try:
+                song = m21.converter.parse(file_path)
+                record = extract_metadata(song, file_path, acceptable_durations)
+            except Exception as error:
+                print(f"Could not catalog {file_path}: {error}")
+                stats["failed"] += 1
+                continue
+
+            record["content_hash"] = content_hash
+            connection.execute(
+                "INSERT OR REPLACE INTO songs VALUES ("
+                ":file_path, :collection, :meter, :key, :key_source, "
+                ":note_count, :durations, :acceptable_duration, :content_hash)",
+                record,
+            )
+            stats["parsed"] += 1
+
+    # forget files that were deleted from the dataset since the last build
+    root = os.path.normpath(dataset_path)
+    for file_path in known_hashes:
+        inside_root = root == "." or file_path == root or file_path.startswith(root + os.sep)
+        if inside_root and file_path not in seen_paths:
+            connection.execute("DELETE FROM songs WHERE file_path = ?", (file_path,))
+            stats["removed"] += 1
+
+    connection.commit()
+    connection.close()
+    return stats
+
+
+def select_songs(catalog_path, collection=None, meter=None, key=None, min_notes=None, acceptable_only=True,
+                 exclude_paths=(TEST_DATASET_PATH,), acceptable_durations=ACCEPTABLE_DURATIONS):
+    """
+    Selects the songs of the catalog that match all of the given filters.
+
+    Parameters
+    ----------
+    catalog_path : str
+        The path to the SQLite catalog file.
+    collection : str, optional
+        Only keep songs in this directory or any of its subdirectories,
+        e.g. "Melodies/deutschl/kinder".
+    meter : str, optional
+        Only keep songs in this meter, e.g. "2/4".
+    key : str, optional
+        Only keep songs in this key, e.g. "F major".
+    min_notes : int, optional
+        Only keep songs with at least this many notes.
+    acceptable_only : bool, optional
+        Only keep songs that pass `has_acceptable_duration`. Defaults to True.
+    exclude_paths : iterable of str, optional
+        Never select songs in these directories, even from a catalog built
+        without excluding them. Defaults to TEST_DATASET_PATH.
+    acceptable_durations : list of float, optional
+        The durations acceptable_only checks the stored durations against,
+        so that a changed list applies without rebuilding the catalog.
+        Defaults to ACCEPTABLE_DURATIONS.
+
+    Returns
+    -------
+    list of str
+        The paths of the matching files, sorted.
+    """
+    clauses = []
+    parameters = []
+    if collection is not None:
+        collection = os.path.normpath(collection)
+        prefix = collection + os.sep
+        # an exact, case sensitive prefix comparison, LIKE would treat "_" as a wildcard
+        clauses.append("(collection = ? OR substr(collection, 1, ?) = ?)")
+        parameters += [collection, len(prefix), prefix]
+    if meter is not None:
+        clauses.append("meter = ?")
+        parameters.append(meter)
+    if key is not None:
+        clauses.append("key = ?")
+        parameters.append(key)
+    if min_notes is not None:
+        clauses.append("note_count >= ?")
+        parameters.append(min_notes)
+
+    query = "SELECT file_path, durations FROM songs"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY file_path"
+
+    connection = connect_catalog(catalog_path)
+    file_paths = []
+    for file_path, durations in connection.execute(query, parameters):
+        if is_inside(file_path, exclude_paths):
+            continue
+        # check against the current list, the stored verdict is that of the list at build time
+        if acceptable_only and any(duration not in acceptable_durations for duration in json.loads(durations)):
+            continue
+        file_paths.append(file_path)
+    connection.close()
+    return file_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the corpus catalog and preprocess a subset of it.")
+    parser.add_argument("--dataset", default=KERN_DATASET_PATH, help="root directory of the song files")
+    parser.add_argument("--catalog", default=CATALOG_PATH, help="path of the SQLite catalog")
+    parser.add_argument("--collection", help="only select songs below this directory")
+    parser.add_argument("--meter", help="only select songs in this meter, e.g. 2/4")
+    parser.add_argument("--key", help="only select songs in this key, e.g. 'F major'")
+    parser.add_argument("--min-notes", type=int, help="only select songs with at least this many notes")
+    parser.add_argument("--include-rejected", action="store_true",
+                        help="also select songs that fail has_acceptable_duration")
+    parser.add_argument("--preprocess", action="store_true", help="encode the selected songs")
+    parser.add_argument("--encoding", choices=sorted(ENCODING_SETTINGS), default=ENCODING)
+    parser.add_argument("--save-dir", help="directory for the encoded songs, defaults to the one of the encoding")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="delete the encoded songs of an earlier run in the save directory")
+    args = parser.parse_args()
+
+    stats = build_catalog(args.dataset, args.catalog)
+    print(f"Catalog updated: {stats}")
+
+    file_paths = select_songs(
+        args.catalog,
+        collection=args.collection,
+        meter=args.meter,
+        key=args.key,
+        min_notes=args.min_notes,
+        acceptable_only=not args.include_rejected,
+    )
+    print(f"Selected {len(file_paths)} songs.")
+
+    if args.preprocess:
+        save_dir = args.save_dir if args.save_dir is not None else ENCODING_SETTINGS[args.encoding]["dataset_path"]
+        preprocess(args.dataset, file_paths=file_paths, save_dir=save_dir, encoding=args.encoding,
+                   overwrite=args.overwrite)
+
+
+if __name__ == "__main__":
+    main()
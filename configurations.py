@@ -9,6 +9,35 @@ NUM_EPOCHS = 50
 BATCH_SIZE = 64
 DELIMETER = "/ "
 
+# "time_series": one symbol per 16th note with "_" holds, "event": one "pitch:steps" symbol per note or rest
+ENCODING = "time_series"
+EVENT_SEQUENCE_LENGTH = 16
+
+# song-aware training: windows never cross song boundaries and are batched by prefix length
+SONG_AWARE_TRAINING = False
+BUCKET_BOUNDARIES = [8, 16, 32, 64]
+
+# speculative decoding: an n-gram model drafts symbols that the LSTM verifies in one batched call
+NGRAM_ORDER = 4
+DRAFT_LENGTH = 4
+
+# evaluation on the held-out test collection
+EVALUATE_EACH_EPOCH = True
+EVALUATION_BATCH_SIZE = 2048
+EVALUATION_TIME_BUDGET = 10  # seconds
+EVALUATION_SEED = 0
+
+# seconds between two checks whether a loaded model changed on disk
+RELOAD_CHECK_INTERVAL = 2.0
+
+# bulk generation: melodies per shard archive and melodies generated together by a worker
+BULK_SHARD_SIZE = 500
+BULK_BATCH_SIZE = 64
+
+# app: finished generations are kept this many seconds, and at most this many generations at once
+GENERATION_TTL = 600
+MAX_GENERATIONS = 32
+
 ACCEPTABLE_DURATIONS = [
     0.25,  # 16th Note
     0.5,  # 8th note
@@ -26,5 +55,39 @@ KERN_DATASET_PATH = "Melodies"
 DATASET_PATH = "Dataset"
 FILE_DATASET_PATH = "file_dataset.txt"
 MAPPING_PATH = "mapping.json"
+INPUTS_PATH = "songs_inputs.pkl"
+TARGETS_PATH = "songs_targets.pkl"
+CATALOG_PATH = "corpus_catalog.db"
+EVALUATION_CACHE_PATH = "test_windows.npz"
 SAVE_MODEL_PATH = "Models/melody_generation_model.keras"
-MODEL_PATH = "./Models/melody_generation_model.h5"
\ No newline at end of file
+MODEL_PATH = SAVE_MODEL_PATH
+EVENT_DATASET_PATH = "Dataset_events"
+EVENT_FILE_DATASET_PATH = "file_dataset_events.txt"
+EVENT_MAPPING_PATH = "mapping_events.json"
+EVENT_INPUTS_PATH = "songs_inputs_events.pkl"
+EVENT_TARGETS_PATH = "songs_targets_events.pkl"
+EVENT_SAVE_MODEL_PATH = "Models/melody_generation_model_events.keras"
+
+# window length, files and an example seed of each encoding
+ENCODING_SETTINGS = {
+    "time_series": {
+        "sequence_length": SEQUENCE_LENGTH,
+        "seed": "60 _ 60 _ 67 _ _ _ 67 _ _ _ 67 _ _ _ 67 _ _ _ 69 _ 65 _ 67 _ _ _ 69 _ 65 _ 69",
+        "dataset_path": DATASET_PATH,
+        "file_dataset_path": FILE_DATASET_PATH,
+        "mapping_path": MAPPING_PATH,
+        "inputs_path": INPUTS_PATH,
+        "targets_path": TARGETS_PATH,
+        "model_path": SAVE_MODEL_PATH,
+    },
+    "event": {
+        "sequence_length": EVENT_SEQUENCE_LENGTH,
+        "seed": "60:2 60:2 67:4 67:4 67:4 67:4 69:2 65:2 67:4 69:2 65:2 69:2",
+        "dataset_path": EVENT_DATASET_PATH,
+        "file_dataset_path": EVENT_FILE_DATASET_PATH,
+        "mapping_path": EVENT_MAPPING_PATH,
+        "inputs_path": EVENT_INPUTS_PATH,
+        "targets_path": EVENT_TARGETS_PATH,
+        "model_path": EVENT_SAVE_MODEL_PATH,
+    },
+}
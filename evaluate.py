@@ -0,0 +1,340 @@
+import os
+os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
+
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+import keras
+
+from configurations import SEQUENCE_LENGTH, \
+    ACCEPTABLE_DURATIONS, \
+    TEST_DATASET_PATH, \
+    MAPPING_PATH, \
+    EVALUATION_CACHE_PATH, \
+    EVALUATION_BATCH_SIZE, \
+    EVALUATION_TIME_BUDGET, \
+    EVALUATION_SEED, \
+    SONG_AWARE_TRAINING, \
+    ENCODING, \
+    ENCODING_SETTINGS
+from preprocess import load_songs_in_kern, has_acceptable_duration, transpose, encode, index_dtype_for
+
+
+def _collection_signature(test_dataset_path, mapping_file_path, sequence_length, encoding, song_aware):
+    """
+    Hashes the test files, their modification times, the mapping, the window
+    length, the encoding and the framing, so that the cache is rebuilt
+    whenever one of them changes.
+    """
+    digest = hashlib.sha256(f"{sequence_length}:{encoding}:{song_aware}".encode())
+    with open(mapping_file_path, "rb") as file:
+        digest.update(file.read())
+    for path, _, files in sorted(os.walk(test_dataset_path)):
+        for file in sorted(files):
+            file_path = os.path.join(path, file)
+            digest.update(f"{file_path}:{os.path.getmtime(file_path)}".encode())
+    return digest.hexdigest()
+
+
+def encode_test_collection(test_dataset_path=TEST_DATASET_PATH, mapping_file_path=MAPPING_PATH,
+                           sequence_length=SEQUENCE_LENGTH, cache_path=EVALUATION_CACHE_PATH,
+                           encoding="time_series", song_aware=False):
+    """
+    Encodes the test collection into evaluation windows and caches them.
+
+    Every song is preprocessed like the training songs and framed by the
+    generation convention: sequence_length delimiters, the song, and a final
+    delimiter. For every symbol after the leading delimiters the window of
+    the sequence_length preceding symbols is an input and the symbol is its
+    target. Songs with unacceptable durations, songs that cannot be
+    transposed and songs with symbols missing from the mapping are skipped.
+
+    Song-aware models are trained on `/ song /` with shorter prefixes at the
+    start of a song, so with song_aware the songs are framed by a single
+    delimiter and the windows are left-padded with -1, which
+    `evaluate_model` turns into the masked all-zero steps of training.
+
+    Parameters
+    ----------
+    test_dataset_path : str, optional
+        The path to the test collection.
+    mapping_file_path : str, optional
+        The file path where the mapping of symbols to indices is saved in JSON
+        format.
+    sequence_length : int, optional
+        The length of the input windows.
+    cache_path : str, optional
+        The path of the .npz cache. Defaults to EVALUATION_CACHE_PATH.
+    encoding : str, optional
+        "time_series" or "event", see `preprocess.encode`.
+    song_aware : bool, optional
+        Whether the model was trained on `SongWindowDataset` batches.
+
+    Returns
+    -------
+    windows : numpy.ndarray
+        An array of shape (number of windows, sequence_length) of symbol indices.
+    targets : numpy.ndarray
+        An array of shape (number of windows,) of target symbol indices.
+    """
+    signature = _collection_signature(test_dataset_path, mapping_file_path, sequence_length, encoding, song_aware)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if str(cache["signature"]) == signature:
+                return cache["windows"], cache["targets"]
+
+    with open(mapping_file_path, "r") as file:
+        mappings = json.load(file)
+    delimiter_index = mappings["/"]
+    index_dtype = index_dtype_for(len(mappings))
+
+    windows = []
+    targets = []
+    for song in load_songs_in_kern(test_dataset_path):
+        if not has_acceptable_duration(song, ACCEPTABLE_DURATIONS):
+            continue
+        try:
+            symbols = encode(transpose(song), encoding=encoding).split()
+            numeric_song = [mappings[symbol] for symbol in symbols]
+        except Exception:
+            continue
+
+        if song_aware:
+            framed = [-1] * (sequence_length - 1) + [delimiter_index] + numeric_song + [delimiter_index]
+        else:
+            framed = [delimiter_index] * sequence_length + numeric_song + [delimiter_index]
+        framed = np.array(framed, dtype=index_dtype)
+        windows.append(np.lib.stride_tricks.sliding_window_view(framed[:-1], sequence_length))
+        targets.append(framed[sequence_length:])
+
+    windows = np.concatenate(windows) if windows else np.empty((0, sequence_length), dtype=index_dtype)
+    targets = np.concatenate(targets) if targets else np.empty(0, dtype=index_dtype)
+
+    np.savez(cache_path, windows=windows, targets=targets, signature=signature)
+    return windows, targets
+
+
+def sample_windows(num_windows, sample_size, seed=EVALUATION_SEED):
+    """
+    Draws a fixed random sample of window indices.
+
+    The same seed always gives the same sample, so metrics on the sample are
+    comparable between epochs.
+
+    Parameters
+    ----------
+    num_windows : int
+        The number of windows to sample from.
+    sample_size : int
+        The number of windows in the sample.
+    seed : int, optional
+        The seed of the random generator. Defaults to EVALUATION_SEED.
+
+    Returns
+    -------
+    numpy.ndarray
+        The sorted indices of the sampled windows.
+    """
+    if sample_size >= num_windows:
+        return np.arange(num_windows)
+    return np.sort(np.random.default_rng(seed).choice(num_windows, size=sample_size, replace=False))
+
+
+def evaluate_model(model, windows, targets, vocabulary_size, batch_size=EVALUATION_BATCH_SIZE, sample=None):
+    """
+    Computes the per-token negative log-likelihood, perplexity and accuracy of
+    a model on encoded evaluation windows.
+
+    The windows are one-hot encoded and evaluated batch by batch.
+
+    Parameters
+    ----------
+    model : keras.Model
+        The model to evaluate.
+    windows : numpy.ndarray
+        The input windows as returned by `encode_test_collection`. Padding
+        (-1) is encoded as an all-zero step.
+    targets : numpy.ndarray
+        The targets as returned by `encode_test_collection`.
+    vocabulary_size : int
+        The number of symbols in the mapping.
+    batch_size : int, optional
+        The number of windows per forward pass.
+    sample : numpy.ndarray, optional
+        The indices of the windows to evaluate, e.g. from `sample_windows`.
+        Defaults to all windows.
+
+    Returns
+    -------
+    dict
+        The "nll", "perplexity", "accuracy", the number of "windows" evaluated,
+        whether they were a "sample" of all windows, and the "seconds" it took.
+    """
+    start_time = time.perf_counter()
+    # the extra all-zero last row is the one-hot vector of the padding index -1
+    identity = np.zeros((vocabulary_size + 1, vocabulary_size), dtype=np.float32)
+    identity[:vocabulary_size] = np.eye(vocabulary_size, dtype=np.float32)
+
+    if sample is not None and len(sample) < len(windows):
+        windows = windows[sample]
+        targets = targets[sample]
+        sampled = True
+    else:
+        sampled = False
+
+    total_nll = 0.0
+    correct = 0
+    for start in range(0, len(windows), batch_size):
+        batch_targets = targets[start:start + batch_size].astype(np.int64)
+        probabilities = np.asarray(model(identity[windows[start:start + batch_size]], training=False))
+
+        target_probabilities = probabilities[np.arange(len(batch_targets)), batch_targets]
+        total_nll -= np.log(np.maximum(target_probabilities, 1e-10)).sum()
+        correct += int((probabilities.argmax(axis=1) == batch_targets).sum())
+
+    nll = total_nll / max(len(targets), 1)
+    return {
+        "nll": float(nll),
+        "perplexity": float(np.exp(nll)),
+        "accuracy": correct / max(len(targets), 1),
+        "windows": len(targets),
+        "sample": sampled,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+class EvaluationCallback(keras.callbacks.Callback):
+    """
+    Evaluates the model on the test collection at the end of every epoch and
+    adds "test_nll", "test_perplexity" and "test_accuracy" to the logs.
+
+    If the whole collection does not fit into the time budget, a fixed
+    random sample of windows that does is evaluated in every epoch. Its size
+    is estimated from the time of one batch at the end of the first epoch.
+    """
+
+    def __init__(self, test_dataset_path=TEST_DATASET_PATH, mapping_file_path=MAPPING_PATH,
+                 sequence_length=SEQUENCE_LENGTH, encoding="time_series", time_budget=EVALUATION_TIME_BUDGET,
+                 song_aware=False):
+        super().__init__()
+        self._windows, self._targets = encode_test_collection(
+            test_dataset_path, mapping_file_path, sequence_length, encoding=encoding, song_aware=song_aware
+        )
+        with open(mapping_file_path, "r") as file:
+            self._vocabulary_size = len(json.load(file))
+        self._time_budget = time_budget
+        self._sample = None
+
+    def _calibrate_sample(self):
+        probe = sample_windows(len(self._windows), EVALUATION_BATCH_SIZE)
+        # the first call includes graph tracing, so time the second one
+        evaluate_model(self.model, self._windows, self._targets, self._vocabulary_size, sample=probe)
+        seconds = evaluate_model(self.model, self._windows, self._targets, self._vocabulary_size,
+                                 sample=probe)["seconds"]
+        seconds_per_window = seconds / max(len(probe), 1)
+        sample_size = max(len(probe), int(self._time_budget / max(seconds_per_window, 1e-9)))
+        self._sample = sample_windows(len(self._windows), sample_size)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self._sample is None:
+            self._calibrate_sample()
+        metrics = evaluate_model(self.model, self._windows, self._targets, self._vocabulary_size, sample=self._sample)
+        coverage = f"sample of {metrics['windows']}/{len(self._windows)}" if metrics["sample"] else "all"
+        print(f" - test_nll: {metrics['nll']:.4f} - test_perplexity: {metrics['perplexity']:.4f}"
+              f" - test_accuracy: {metrics['accuracy']:.4f} ({coverage} windows, {metrics['seconds']:.1f}s)")
+        if logs is not None:
+            logs["test_nll"] = metrics["nll"]
+            logs["test_perplexity"] = metrics["perplexity"]
+            logs["test_accuracy"] = metrics["accuracy"]
+
+
+def compare_models(candidate_path, baseline_path=None, tolerance=0.0, mapping_file_path=None,
+                   song_aware=SONG_AWARE_TRAINING, baseline_song_aware=None, encoding=ENCODING):
+    """
+    Evaluates a candidate model and decides whether it may replace the
+    baseline model.
+
+    Both models are evaluated on the same windows without a time budget.
+
+    Parameters
+    ----------
+    candidate_path : str
+        The path to the new model.
+    baseline_path : str, optional
+        The path to the deployed model. Without a baseline the candidate
+        always passes.
+    tolerance : float, optional
+        How much higher the candidate's negative log-likelihood may be than
+        the baseline's.
+    mapping_file_path : str, optional
+        The file path where the mapping of symbols to indices is saved in JSON
+        format. Defaults to the mapping of the encoding.
+    song_aware : bool, optional
+        Whether the candidate was trained on `SongWindowDataset` batches.
+    baseline_song_aware : bool, optional
+        Whether the baseline was. Defaults to song_aware.
+    encoding : str, optional
+        "time_series" or "event", the encoding both models were trained on.
+
+    Returns
+    -------
+    passed : bool
+        True if the candidate is at least as good as the baseline.
+    results : dict
+        The metrics of the "candidate" and, if given, the "baseline".
+    """
+    settings = ENCODING_SETTINGS[encoding]
+    if mapping_file_path is None:
+        mapping_file_path = settings["mapping_path"]
+    if baseline_song_aware is None:
+        baseline_song_aware = song_aware
+    with open(mapping_file_path, "r") as file:
+        vocabulary_size = len(json.load(file))
+
+    results = {}
+    for name, model_path, framing in (("candidate", candidate_path, song_aware),
+                                      ("baseline", baseline_path, baseline_song_aware)):
+        if model_path is not None:
+            windows, targets = encode_test_collection(mapping_file_path=mapping_file_path,
+                                                      sequence_length=settings["sequence_length"],
+                                                      encoding=encoding, song_aware=framing)
+            model = keras.models.load_model(model_path)
+            results[name] = evaluate_model(model, windows, targets, vocabulary_size)
+
+    passed = "baseline" not in results or results["candidate"]["nll"] <= results["baseline"]["nll"] + tolerance
+    return passed, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a model on the held-out test collection.")
+    parser.add_argument("model", nargs="?", help="path of the model to evaluate, defaults to the model of the encoding")
+    parser.add_argument("--baseline", help="path of the deployed model the candidate must not be worse than")
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="allowed increase of the negative log-likelihood over the baseline")
+    parser.add_argument("--song-aware", action=argparse.BooleanOptionalAction, default=SONG_AWARE_TRAINING,
+                        help="the candidate was trained on song-aware batches")
+    parser.add_argument("--baseline-song-aware", action=argparse.BooleanOptionalAction,
+                        help="the baseline was trained on song-aware batches (defaults to --song-aware)")
+    parser.add_argument("--encoding", choices=sorted(ENCODING_SETTINGS), default=ENCODING)
+    parser.add_argument("--mapping", help="defaults to the mapping of the encoding")
+    args = parser.parse_args()
+
+    model_path = args.model if args.model is not None else ENCODING_SETTINGS[args.encoding]["model_path"]
+    passed, results = compare_models(model_path, args.baseline, args.tolerance, mapping_file_path=args.mapping,
+                                     song_aware=args.song_aware, baseline_song_aware=args.baseline_song_aware,
+                                     encoding=args.encoding)
+    for name, metrics in results.items():
+        print(f"{name}: nll {metrics['nll']:.4f}, perplexity {metrics['perplexity']:.4f}, "
+              f"accuracy {metrics['accuracy']:.4f} on {metrics['windows']} windows in {metrics['seconds']:.1f}s")
+
+    if not passed:
+        print("The candidate model is worse than the baseline.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,31 +2,154 @@ import os
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 # os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-import json
+import asyncio
+import itertools
+import threading
+import concurrent.futures
+
 import numpy as np
 import keras
 import music21 as m21
 
 
-from configurations import MAPPING_PATH, SEQUENCE_LENGTH, MODEL_PATH, SAVE_MODEL_PATH, LOSS
+from configurations import DRAFT_LENGTH, ENCODING, ENCODING_SETTINGS, SONG_AWARE_TRAINING
+from model_registry import MODEL_REGISTRY
+from ngram import load_ngram_model
+
+
+def melody_to_note_events(symbols, step_duration=0.25, encoding="time_series"):
+    """
+    Groups a sequence of symbols into notes and rests.
+
+    An event is yielded as soon as the next note or rest starts, and the last
+    one when the symbols are exhausted, so the symbols may come from a stream.
+    Event symbols already carry their duration and are yielded immediately.
+
+    Parameters
+    ----------
+    symbols : iterable of str
+        The symbols of a melody, e.g. '60', '_', '_', '_', '62', '_', ....
+    step_duration : float, optional
+        The duration of each step in quarter lengths. Defaults to 0.25.
+    encoding : str, optional
+        "time_series" or "event". Defaults to "time_series".
+
+    Yields
+    ------
+    tuple of (str, float)
+        The pitch symbol ("r" for a rest) and the quarter length of each event.
+    """
+    if encoding == "event":
+        for symbol in symbols:
+            pitch, steps = symbol.split(":")
+            yield pitch, step_duration * int(steps)
+        return
+
+    current_symbol = None
+    step_counter = 0
+    for symbol in symbols:
+        if symbol == "_":
+            step_counter += 1
+            continue
+        if current_symbol is not None:
+            yield current_symbol, step_duration * step_counter
+        current_symbol = symbol
+        step_counter = 1
+    if current_symbol is not None:
+        yield current_symbol, step_duration * step_counter
+
+
+def melody_to_midi_bytes(melody, step_duration=0.25, encoding="time_series"):
+    """
+    Converts a melody to the content of a MIDI file without writing to disk.
+
+    Parameters
+    ----------
+    melody : list
+        A list of symbols representing the melody.
+    step_duration : float, optional
+        The duration of each step in quarter lengths. Defaults to 0.25.
+    encoding : str, optional
+        "time_series" or "event". Defaults to "time_series".
+
+    Returns
+    -------
+    bytes
+        The MIDI file content.
+    """
+    stream = m21.stream.Stream()
+    for symbol, quarter_length in melody_to_note_events(melody, step_duration, encoding):
+        if symbol == "r":
+            stream.append(m21.note.Rest(quarterLength=quarter_length))
+        else:
+            stream.append(m21.note.Note(int(symbol), quarterLength=quarter_length))
+    return m21.midi.translate.streamToMidiFile(stream).writestr()
+
 
 class MelodyGenerator:
-    def __init__(self, model_path=MODEL_PATH):
+    def __init__(self, model_path=None, mapping_path=None, registry=MODEL_REGISTRY, encoding=ENCODING,
+                 song_aware=SONG_AWARE_TRAINING):
         """
         Initializes the MelodyGenerator class.
 
+        The model and mapping are loaded through the registry, so generators
+        using the same files share one copy of the model, and a model file
+        replaced on disk is picked up by the next generation.
+
         Parameters
         ----------
-        model_path : str
-            The path to the model to be used for generating melodies.
+        model_path : str, optional
+            The path to the model to be used for generating melodies. Defaults
+            to the model of the encoding.
+        mapping_path : str, optional
+            The path to the mapping of symbols to indices. Defaults to the
+            mapping of the encoding.
+        registry : model_registry.ModelRegistry, optional
+            The registry to load the model from. Defaults to the process-wide
+            MODEL_REGISTRY.
+        encoding : str, optional
+            "time_series" or "event", the encoding the model was trained on.
+            Seeds, generated symbols and num_steps use this encoding, e.g. the
+            seed '60:2 62:2 64:4' and one step per note in the event encoding.
+            Defaults to ENCODING.
+        song_aware : bool, optional
+            Whether the model was trained on `SongWindowDataset` batches. Such
+            a model has only seen a single "/" before the start of a song, so
+            the seed is prefixed with one start symbol instead of a full window
+            of them. Defaults to SONG_AWARE_TRAINING.
         """
-        self.model_path = model_path
-        self.model = keras.models.load_model(model_path)
-        
-        with open(MAPPING_PATH, "r") as mapping_file:
-            self._mapping = json.load(mapping_file)
+        settings = ENCODING_SETTINGS[encoding]
+        self.encoding = encoding
+        self.sequence_length = settings["sequence_length"]
+        self.model_path = model_path if model_path is not None else settings["model_path"]
+        self.mapping_path = mapping_path if mapping_path is not None else settings["mapping_path"]
+        self._registry = registry
+        # load eagerly so that a wrong path fails here and not in the first generation
+        self._acquire()
+
+        self._start_symbols = ["/"] if song_aware else ["/"] * self.sequence_length
+
+    @property
+    def model(self):
+        """
+        The current version of the model.
+        """
+        return self._acquire().model
+
+    @property
+    def mapping(self):
+        """
+        The current mapping of symbols to indices, i.e. the symbols a seed may
+        contain.
+        """
+        return self._acquire().mapping
 
-        self._start_symbols = ["/"] * SEQUENCE_LENGTH
+    def _acquire(self):
+        """
+        Returns the current model/mapping pair. A generation uses the returned
+        pair until it finishes, even if the model is reloaded meanwhile.
+        """
+        return self._registry.get(self.model_path, self.mapping_path, self.sequence_length)
 
     def generate_melody(self, seed, num_steps, max_sequence_length, temperature):
         """
@@ -49,29 +172,64 @@ class MelodyGenerator:
         list
             A list of notes representing the generated melody.
         """
-        
+        melody = seed.split()
+        melody.extend(self.stream_melody(seed, num_steps, max_sequence_length, temperature))
+        return melody
+    
+    def stream_melody(self, seed, num_steps, max_sequence_length, temperature, cancel_event=None):
+        """
+        Generates the continuation of a seed symbol by symbol, yielding every
+        symbol as soon as it is sampled.
+
+        The caller can stop the generation at any time by no longer iterating
+        (or closing the generator), or from another thread by setting
+        cancel_event.
+
+        Parameters
+        ----------
+        seed : str
+            The initial sequence of notes to generate from.
+            Example: '55 _ 60 _ 64 _ 67 _ 69 _ 67 _ _ 65'
+        num_steps : int
+            The number of steps to generate the melody for.
+        max_sequence_length : int
+            The maximum length of the sequence to generate.
+        temperature : float
+            The temperature parameter to use for sampling from the output distribution.
+        cancel_event : threading.Event, optional
+            Stops the generation before the next step once it is set.
+
+        Yields
+        ------
+        str
+            The generated symbols, without the seed and the end symbol.
+        """
+        loaded = self._acquire()
+
         # create seed with start symbols
-        seed = seed.split()
-        melody = seed
-        seed = self._start_symbols + seed
-        
+        seed = self._start_symbols + seed.split()
+
         # map seed to numbers
-        seed = [self._mapping[symbol] for symbol in seed]
-        
+        seed = [loaded.mapping[symbol] for symbol in seed]
+
         for _ in range(num_steps):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+
             # limit the seed to max_sequence_length
             seed = seed[-max_sequence_length:]
 
             # one-hot encode the seed
-            onehot_seed = keras.utils.to_categorical(seed, num_classes=len(self._mapping))
-            # dimension of onehot_seed: (max_sequence_length, len(self._mapping))
-            # but the model expects the dimension to be (batch_size, max_sequence_length, len(self._mapping))
+            onehot_seed = keras.utils.to_categorical(seed, num_classes=len(loaded.mapping))
+            # dimension of onehot_seed: (max_sequence_length, len(loaded.mapping))
+            # but the model expects the dimension to be (batch_size, max_sequence_length, len(loaded.mapping))
             # so we add a batch dimension to the seed
             onehot_seed = onehot_seed[np.newaxis, ...]
 
             # make a prediction
             # As we can pass multiple samples at once, and we only have one sample, we take the first one
-            probabilities = self.model.predict(onehot_seed, verbose=0)[0]
+            # calling the model directly avoids the per-call overhead of predict for a single sample
+            probabilities = np.asarray(loaded.model(onehot_seed, training=False))[0]
             # probailities will be an array [0.1, 0.2, 0.1, 0.6,.....] of output units dimension whose sum is 1
             # we will sample from this array to get the next symbol
             output_int = self._sample_with_temperature(probabilities, temperature)
@@ -80,16 +238,306 @@ class MelodyGenerator:
             seed.append(output_int)
 
             # map the output int to the symbol
-            output_symbol = [key for key, val in self._mapping.items() if val == output_int][0]
+            output_symbol = loaded.symbols[output_int]
 
             # check if we have reached the end of the melody
             if output_symbol == "/":
-                break   
-            # update the melody
-            melody.append(output_symbol)
+                return
+            yield output_symbol
+
+    def stream_note_events(self, seed, num_steps, max_sequence_length, temperature, step_duration=0.25,
+                           cancel_event=None):
+        """
+        Generates a melody like `stream_melody`, but yields every note or rest
+        of the melody, seed included, as soon as its duration is known.
+
+        Parameters
+        ----------
+        seed : str
+            The initial sequence of notes to generate from.
+        num_steps : int
+            The number of steps to generate the melody for.
+        max_sequence_length : int
+            The maximum length of the sequence to generate.
+        temperature : float
+            The temperature parameter to use for sampling from the output distribution.
+        step_duration : float, optional
+            The duration of each step in quarter lengths. Defaults to 0.25.
+        cancel_event : threading.Event, optional
+            Stops the generation before the next step once it is set.
+
+        Yields
+        ------
+        tuple of (str, float)
+            The pitch symbol ("r" for a rest) and the quarter length of each event.
+        """
+        symbols = itertools.chain(
+            seed.split(),
+            self.stream_melody(seed, num_steps, max_sequence_length, temperature, cancel_event),
+        )
+        yield from melody_to_note_events(symbols, step_duration, self.encoding)
+
+    async def astream_melody(self, seed, num_steps, max_sequence_length, temperature, cancel_event=None):
+        """
+        Asynchronous variant of `stream_melody`. Every step runs in a worker
+        thread so the event loop is not blocked, and cancelling the consuming
+        task stops the generation after the current step.
+
+        Parameters
+        ----------
+        seed : str
+            The initial sequence of notes to generate from.
+        num_steps : int
+            The number of steps to generate the melody for.
+        max_sequence_length : int
+            The maximum length of the sequence to generate.
+        temperature : float
+            The temperature parameter to use for sampling from the output distribution.
+        cancel_event : threading.Event, optional
+            Stops the generation before the next step once it is set. It is
+            only read, never set, by this method.
+
+        Yields
+        ------
+        str
+            The generated symbols, without the seed and the end symbol.
+        """
+        # only an event created here may be set when the stream ends, the
+        # caller's event could be shared with other generations
+        own_cancel_event = cancel_event is None
+        if own_cancel_event:
+            cancel_event = threading.Event()
+        symbols = self.stream_melody(seed, num_steps, max_sequence_length, temperature, cancel_event)
+        # a single thread of its own, so no two steps of the generator ever run at once
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        finished = object()
+        step = None
+        try:
+            while True:
+                step = executor.submit(next, symbols, finished)
+                symbol = await asyncio.wrap_future(step)
+                if symbol is finished:
+                    break
+                yield symbol
+        finally:
+            if own_cancel_event:
+                cancel_event.set()
+            if step is None or step.done():
+                symbols.close()
+            else:
+                # closing a running generator raises, so close it after the current step
+                step.add_done_callback(lambda _: symbols.close())
+            executor.shutdown(wait=False)
+
+    def generate_melodies(self, seeds, num_steps, max_sequence_length, temperatures):
+        """
+        Generates one melody per seed, advancing all melodies together with a
+        single batched model call per step.
+
+        Parameters
+        ----------
+        seeds : list of str
+            The initial sequences of notes to generate from.
+        num_steps : int or list of int
+            The number of steps to generate, for all melodies or per melody.
+        max_sequence_length : int
+            The maximum length of the sequence to generate.
+        temperatures : float or list of float
+            The sampling temperature, for all melodies or per melody.
+
+        Returns
+        -------
+        list of list
+            The generated melodies, seed included, in the order of the seeds.
+        """
+        loaded = self._acquire()
+        if not isinstance(num_steps, (list, tuple)):
+            num_steps = [num_steps] * len(seeds)
+        if not isinstance(temperatures, (list, tuple)):
+            temperatures = [temperatures] * len(seeds)
+
+        melodies = [seed.split() for seed in seeds]
+        contexts = [[loaded.mapping[symbol] for symbol in self._start_symbols + melody] for melody in melodies]
+        remaining = list(num_steps)
+        active = [i for i in range(len(seeds)) if remaining[i] > 0]
+
+        while active:
+            windows = {i: contexts[i][-max_sequence_length:] for i in active}
+            # melodies with windows of equal length share one forward pass
+            for length in sorted({len(window) for window in windows.values()}):
+                rows = [i for i in active if len(windows[i]) == length]
+                onehot = keras.utils.to_categorical([windows[i] for i in rows], num_classes=len(loaded.mapping))
+                probabilities = np.asarray(loaded.model(onehot, training=False))
+
+                for i, distribution in zip(rows, probabilities):
+                    output_int = self._sample_with_temperature(distribution, temperatures[i])
+                    contexts[i].append(output_int)
+                    remaining[i] -= 1
+                    output_symbol = loaded.symbols[output_int]
+                    if output_symbol == "/":
+                        remaining[i] = 0
+                    else:
+                        melodies[i].append(output_symbol)
+
+            active = [i for i in active if remaining[i] > 0]
+
+        return melodies
+
+    def generate_melody_speculative(self, seed, num_steps, max_sequence_length, temperature,
+                                    draft_model, draft_length=DRAFT_LENGTH):
+        """
+        Generates a melody like `generate_melody`, but lets a cheap draft model
+        propose several symbols ahead that the LSTM verifies together.
+
+        Each round the draft model samples `draft_length` symbols. The LSTM
+        then scores every prefix of the draft in a single batched call, and
+        each drafted symbol is accepted with probability min(1, p / q), where
+        p and q are the temperature-scaled model and draft probabilities. The
+        first rejected symbol is resampled from the normalised max(0, p - q),
+        and if the whole draft is accepted one more symbol is sampled from the
+        model. The generated melody therefore follows exactly the distribution
+        of `generate_melody`, while hold symbols ("_"), which the draft model
+        predicts well, cost a fraction of a model call.
+
+        Parameters
+        ----------
+        seed : str
+            The initial sequence of notes to generate from.
+        num_steps : int
+            The number of steps to generate the melody for.
+        max_sequence_length : int
+            The maximum length of the sequence to generate.
+        temperature : float
+            The temperature parameter to use for sampling from the output distribution.
+        draft_model : ngram.NGramModel
+            The model drafting the symbols, e.g. from `ngram.load_ngram_model`.
+        draft_length : int, optional
+            The number of symbols drafted per round. Defaults to DRAFT_LENGTH.
+
+        Returns
+        -------
+        melody : list
+            A list of notes representing the generated melody.
+        stats : dict
+            The number of "model_calls" (forward passes), "drafted" and "accepted" symbols, the
+            "acceptance_rate" and the generated "tokens_per_model_call".
+        """
+        loaded = self._acquire()
+
+        seed = seed.split()
+        melody = seed
+        seed = [loaded.mapping[symbol] for symbol in self._start_symbols + seed]
+        end_index = loaded.mapping["/"]
+
+        stats = {"model_calls": 0, "drafted": 0, "accepted": 0}
+        generated = 0
+        finished = False
+        while generated < num_steps and not finished:
+            # draft symbols with the n-gram model
+            draft = []
+            draft_distributions = []
+            context = list(seed)
+            for _ in range(min(draft_length, num_steps - generated)):
+                q = self._apply_temperature(draft_model.distribution(context), temperature)
+                symbol = np.random.choice(len(q), p=q)
+                draft.append(symbol)
+                draft_distributions.append(q)
+                context.append(symbol)
+                if symbol == end_index:
+                    break
+
+            # score all prefixes of the draft with the model at once
+            model_distributions, forward_passes = self._predict_prefixes(loaded, seed, draft, max_sequence_length)
+            stats["model_calls"] += forward_passes
+            stats["drafted"] += len(draft)
+
+            # verify the draft symbol by symbol
+            accepted = []
+            for symbol, q, p in zip(draft, draft_distributions, model_distributions):
+                p = self._apply_temperature(p, temperature)
+                if np.random.random() < min(1.0, p[symbol] / q[symbol]):
+                    accepted.append(symbol)
+                    stats["accepted"] += 1
+                    continue
+                residual = np.maximum(p - q, 0)
+                accepted.append(np.random.choice(len(residual), p=residual / residual.sum()))
+                break
+            else:
+                if len(accepted) < num_steps - generated:
+                    p = self._apply_temperature(model_distributions[len(draft)], temperature)
+                    accepted.append(np.random.choice(len(p), p=p))
+
+            for symbol in accepted:
+                seed.append(symbol)
+                generated += 1
+                # check if we have reached the end of the melody
+                if symbol == end_index:
+                    finished = True
+                    break
+                melody.append(loaded.symbols[symbol])
+
+        stats["acceptance_rate"] = stats["accepted"] / max(stats["drafted"], 1)
+        stats["tokens_per_model_call"] = generated / max(stats["model_calls"], 1)
+        return melody, stats
+
+    def _predict_prefixes(self, loaded, seed, draft, max_sequence_length):
+        """
+        Predicts the next-symbol distribution after the seed and after every
+        prefix of the draft, batching prefixes of equal window length into a
+        single forward pass.
+
+        Parameters
+        ----------
+        loaded : model_registry.LoadedModel
+            The model/mapping pair of the current generation.
+        seed : list of int
+            The symbol indices generated so far.
+        draft : list of int
+            The drafted symbol indices.
+        max_sequence_length : int
+            The maximum length of the windows fed to the model.
+
+        Returns
+        -------
+        distributions : list of numpy.ndarray
+            len(draft) + 1 distributions, one per prefix.
+        forward_passes : int
+            The number of forward passes, one per distinct window length.
+            Windows shorter than max_sequence_length have different lengths,
+            so this is up to len(draft) + 1 at the start of a melody.
+        """
+        windows = [(seed + draft[:i])[-max_sequence_length:] for i in range(len(draft) + 1)]
+        distributions = [None] * len(windows)
+        lengths = sorted({len(window) for window in windows})
+        for length in lengths:
+            rows = [i for i, window in enumerate(windows) if len(window) == length]
+            onehot = keras.utils.to_categorical([windows[i] for i in rows], num_classes=len(loaded.mapping))
+            probabilities = np.asarray(loaded.model(onehot, training=False))
+            for row, distribution in zip(rows, probabilities):
+                distributions[row] = distribution.astype(np.float64)
+        return distributions, len(lengths)
+
+    def _apply_temperature(self, probabilities, temperature):
+        """
+        Rescales a probability distribution with the sampling temperature.
+
+        Parameters
+        ----------
+        probabilities : numpy.ndarray
+            An array representing the probability distribution over possible choices.
+        temperature : float
+            A parameter that controls the randomness of the sampling process.
+
+        Returns
+        -------
+        numpy.ndarray
+            The rescaled distribution, summing to 1.
+        """
+        epsilon = 1e-10
+        predictions = np.log(np.asarray(probabilities, dtype=np.float64) + epsilon) / temperature
+        predictions = np.exp(predictions - np.max(predictions))
+        return predictions / np.sum(predictions)
 
-        return melody
-    
     def _sample_with_temperature(self, probabilities, temperature):
         """
         Samples an index from a probability distribution using temperature scaling.
@@ -119,9 +567,7 @@ class MelodyGenerator:
         # if temperature -> infinity, all probabilities will be the same, its like randomly selecting one of the symbols
         # if temperature -> 0, we will always select the symbol with the highest probability
         # if temperature = 1, we will sample from the given probabilities, which is the most common scenario
-        epsilon = 1e-10
-        predictions = np.log(predictions + epsilon) / temperature
-        probabilities = np.exp(predictions) / np.sum(np.exp(predictions))
+        probabilities = self._apply_temperature(probabilities, temperature)
         choices = range(len(probabilities)) # [0, 1, 2, 3, ...., len(probabilities)]
         index = np.random.choice(choices, p=probabilities)
     
@@ -146,30 +592,18 @@ class MelodyGenerator:
         # Create a music21 stream
         stream = m21.stream.Stream()
 
-        # Parse all symbols and convert them into note/rest objects.
-        # '60', '_', '_', '_', '62', '_', ....
-        current_symbol = None
-        step_counter = 1
-        for i, symbol in enumerate(melody):
-            # handle note or rest
-            if symbol != "_" or i+1==len(melody):
-                if current_symbol is not None:
-                    quarter_length_duration = step_duaration * step_counter
-                    # handle a rest
-                    if current_symbol == "r":
-                        m21_event = m21.note.Rest(quarterLength=quarter_length_duration)
-
-                    # handle a note
-                    else:
-                        m21_event = m21.note.Note(int(current_symbol), quarterLength=quarter_length_duration)
+        # Group the symbols into notes/rests with their durations, including the last one.
+        # '60', '_', '_', '_', '62', '_', .... -> ('60', 1.0), ('62', 0.5), ....
+        for symbol, quarter_length_duration in melody_to_note_events(melody, step_duaration, self.encoding):
+            # handle a rest
+            if symbol == "r":
+                m21_event = m21.note.Rest(quarterLength=quarter_length_duration)
 
-                    stream.append(m21_event)
-                    step_counter = 1
-                current_symbol = symbol
-
-            # handle prolongations "_"
+            # handle a note
             else:
-                step_counter += 1
+                m21_event = m21.note.Note(int(symbol), quarterLength=quarter_length_duration)
+
+            stream.append(m21_event)
 
         # write a m21 stream to a midi file
         stream.write(format, output_path)
@@ -179,17 +613,15 @@ class MelodyGenerator:
 
 if __name__ == "__main__":
    
-    melody_generator = MelodyGenerator(model_path=SAVE_MODEL_PATH)
-    seed = "60 _ 60 _ 67 _ _ _ 67 _ _ _ 67 _ _ _ 67 _ _ _ 69 _ 65 _ 67 _ _ _ 69 _ 65 _ 69"
-    melody = melody_generator.generate_melody(seed, 500, 64, 0.76)
+    melody_generator = MelodyGenerator()
+    seed = ENCODING_SETTINGS[melody_generator.encoding]["seed"]
+    sequence_length = melody_generator.sequence_length
+    melody = melody_generator.generate_melody(seed, 500, sequence_length, 0.76)
     print(melody)
+    # the n-gram model must draft with the indices of the generator's mapping
+    ngram_model = load_ngram_model(mapping_file_path=melody_generator.mapping_path, encoding=melody_generator.encoding)
+    _, stats = melody_generator.generate_melody_speculative(seed, 500, sequence_length, 0.76, ngram_model)
+    print(f"Speculative decoding: acceptance rate {stats['acceptance_rate']:.2f}, "
+          f"{stats['tokens_per_model_call']:.2f} tokens per model call")
     song = melody_generator.save_melody(melody, output_path="mel_model_k.mid")
     song.show()
-
-        
-
-
-
-
-
-
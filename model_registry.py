@@ -0,0 +1,147 @@
+import os
+os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
+
+import json
+import time
+import threading
+
+import numpy as np
+import keras
+
+from configurations import SEQUENCE_LENGTH, MODEL_PATH, MAPPING_PATH, RELOAD_CHECK_INTERVAL
+
+
+class LoadedModel:
+    """
+    A model and its mapping as loaded together from disk.
+
+    Instances are never modified after loading, so a generation that holds
+    one keeps using the same model and mapping even if the registry has
+    swapped in a newer version in the meantime.
+    """
+
+    def __init__(self, model, mapping, signature):
+        self.model = model
+        self.mapping = mapping
+        self.symbols = {index: symbol for symbol, index in mapping.items()}
+        self.signature = signature
+
+
+class ModelRegistry:
+    """
+    Loads every model/mapping pair once per process and shares it between all
+    `MelodyGenerator` instances.
+
+    The registry checks at most every `reload_check_interval` seconds whether
+    the model or mapping file changed on disk. A changed pair is loaded and
+    warmed up next to the old one and then swapped in with a single reference
+    assignment, so generations that already hold the old `LoadedModel` finish
+    undisturbed.
+    """
+
+    def __init__(self, reload_check_interval=RELOAD_CHECK_INTERVAL):
+        """
+        Initializes the ModelRegistry class.
+
+        Parameters
+        ----------
+        reload_check_interval : float, optional
+            The minimum number of seconds between two checks of the files on
+            disk. Defaults to RELOAD_CHECK_INTERVAL.
+        """
+        self.reload_check_interval = reload_check_interval
+        self._entries = {}
+        self._last_checks = {}
+        self._load_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_path=MODEL_PATH, mapping_path=MAPPING_PATH, warmup_length=SEQUENCE_LENGTH):
+        """
+        Returns the loaded model/mapping pair, loading or reloading it if
+        needed.
+
+        Parameters
+        ----------
+        model_path : str, optional
+            The path to the model.
+        mapping_path : str, optional
+            The path to the mapping of symbols to indices.
+        warmup_length : int, optional
+            The window length of the dummy forward pass when the model is
+            (re)loaded, i.e. the window length of the encoding.
+
+        Returns
+        -------
+        LoadedModel
+            The current version of the pair.
+        """
+        key = (os.path.abspath(model_path), os.path.abspath(mapping_path))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and now - self._last_checks[key] < self.reload_check_interval:
+                return entry
+            self._last_checks[key] = now
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        try:
+            signature = _file_signature(*key)
+        except OSError:
+            if entry is None:
+                raise
+            # the file is being replaced right now, keep serving the old version
+            return entry
+        if entry is not None and entry.signature == signature:
+            return entry
+
+        # only one thread loads a given pair, the others wait for its result
+        with load_lock:
+            entry = self._entries.get(key)
+            try:
+                if entry is not None and entry.signature == _file_signature(*key):
+                    return entry
+                new_entry = _load(*key, warmup_length)
+            except Exception as error:
+                if entry is None:
+                    raise
+                # the file may still be being written, keep serving the old version
+                print(f"Could not reload {model_path}: {error}")
+                return entry
+            with self._lock:
+                self._entries[key] = new_entry
+            return new_entry
+
+    def clear(self):
+        """
+        Drops all loaded models, e.g. to free memory.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._last_checks.clear()
+
+
+def _file_signature(model_path, mapping_path):
+    model_stat = os.stat(model_path)
+    mapping_stat = os.stat(mapping_path)
+    return model_stat.st_mtime_ns, model_stat.st_size, mapping_stat.st_mtime_ns, mapping_stat.st_size
+
+
+def _load(model_path, mapping_path, warmup_length):
+    """
+    Loads a model and its mapping and warms the model up with a dummy forward
+    pass through `model(..., training=False)`, the call all generation paths
+    use, so that the first generation does not pay for the first call.
+    """
+    signature = _file_signature(model_path, mapping_path)
+    model = keras.models.load_model(model_path)
+    with open(mapping_path, "r") as mapping_file:
+        mapping = json.load(mapping_file)
+
+    model(np.zeros((1, warmup_length, len(mapping)), dtype=np.float32), training=False)
+
+    return LoadedModel(model, mapping, signature)
+
+
+# registry shared by all generators of the process
+MODEL_REGISTRY = ModelRegistry()
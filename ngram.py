@@ -0,0 +1,117 @@
+import json
+from collections import Counter
+
+import numpy as np
+
+from configurations import NGRAM_ORDER, ENCODING, ENCODING_SETTINGS
+
+
+class NGramModel:
+    """
+    A back-off n-gram model over the symbol indices of the single file dataset.
+
+    It is cheap enough to draft several symbols ahead for speculative decoding
+    in `MelodyGenerator.generate_melody_speculative`.
+    """
+
+    def __init__(self, vocabulary_size, order=NGRAM_ORDER, smoothing=0.01):
+        """
+        Initializes the NGramModel class.
+
+        Parameters
+        ----------
+        vocabulary_size : int
+            The number of symbols in the mapping.
+        order : int, optional
+            The length of the n-grams, i.e. the context length plus one.
+        smoothing : float, optional
+            The pseudo count added to every symbol so that no distribution
+            contains zeros.
+        """
+        self.vocabulary_size = vocabulary_size
+        self.order = order
+        self.smoothing = smoothing
+        # sparse counts per context, most contexts are followed by few symbols
+        self._counts = {}
+
+    def fit(self, numeric_songs):
+        """
+        Counts all n-grams of orders 1 to `order` in the sequence.
+
+        Parameters
+        ----------
+        numeric_songs : list of int
+            The dataset as symbol indices, e.g. from `convert_songs_to_numeric`.
+
+        Returns
+        -------
+        NGramModel
+            The fitted model.
+        """
+        for context_length in range(self.order):
+            for i in range(context_length, len(numeric_songs)):
+                context = tuple(numeric_songs[i - context_length:i])
+                self._counts.setdefault(context, Counter())[numeric_songs[i]] += 1
+        return self
+
+    def distribution(self, context):
+        """
+        Returns the next-symbol distribution for the longest seen suffix of
+        the context.
+
+        Parameters
+        ----------
+        context : list of int
+            The preceding symbol indices.
+
+        Returns
+        -------
+        numpy.ndarray
+            The probability of each symbol.
+        """
+        for context_length in range(min(self.order - 1, len(context)), -1, -1):
+            suffix = tuple(context[len(context) - context_length:])
+            counts = self._counts.get(suffix)
+            if counts is not None:
+                dense_counts = np.full(self.vocabulary_size, self.smoothing)
+                dense_counts[list(counts)] += list(counts.values())
+                return dense_counts / dense_counts.sum()
+        return np.full(self.vocabulary_size, 1 / self.vocabulary_size)
+
+
+def load_ngram_model(full_dataset_file_path=None, mapping_file_path=None, order=NGRAM_ORDER, encoding=ENCODING):
+    """
+    Fits an n-gram model on the single file dataset.
+
+    Parameters
+    ----------
+    full_dataset_file_path : str, optional
+        The path to the file containing the sequence of encoded songs.
+        Defaults to the single file dataset of the encoding.
+    mapping_file_path : str, optional
+        The file path where the mapping of symbols to indices is saved in JSON
+        format. Defaults to the mapping of the encoding, which must be the
+        mapping of the model the n-gram model drafts for.
+    order : int, optional
+        The length of the n-grams.
+    encoding : str, optional
+        "time_series" or "event".
+
+    Returns
+    -------
+    NGramModel
+        The fitted model.
+    """
+    settings = ENCODING_SETTINGS[encoding]
+    if full_dataset_file_path is None:
+        full_dataset_file_path = settings["file_dataset_path"]
+    if mapping_file_path is None:
+        mapping_file_path = settings["mapping_path"]
+
+    with open(mapping_file_path, "r") as file:
+        mappings = json.load(file)
+
+    with open(full_dataset_file_path, "r") as file:
+        numeric_songs = [mappings[symbol] for symbol in file.read().split()]
+
+    return NGramModel(len(mappings), order=order).fit(numeric_songs)
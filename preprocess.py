@@ -11,14 +11,41 @@ import keras
 
 from configurations import SEQUENCE_LENGTH, \
     DELIMETER, \
+    BATCH_SIZE, \
+    BUCKET_BOUNDARIES, \
     ACCEPTABLE_DURATIONS, \
     KERN_DATASET_PATH, \
     DATASET_PATH, \
-    FILE_DATASET_PATH, \
-    MAPPING_PATH
+    TEST_DATASET_PATH, \
+    ENCODING, \
+    ENCODING_SETTINGS
 
 
-def load_songs_in_kern(dataset_path):
+def is_inside(path, directories):
+    """
+    Checks if a path is one of the directories or lies below one of them.
+
+    Parameters
+    ----------
+    path : str
+        The path to check.
+    directories : iterable of str
+        The directories.
+
+    Returns
+    -------
+    bool
+        True if path is inside one of the directories, False otherwise.
+    """
+    path = os.path.normpath(path)
+    for directory in directories:
+        directory = os.path.normpath(directory)
+        if path == directory or path.startswith(directory + os.sep):
+            return True
+    return False
+
+
+def load_songs_in_kern(dataset_path, exclude_paths=()):
     """
     Walks through the directory tree rooted at dataset_path and loads all files
     with extension "krn" or "musicxml" using music21. Each song is added to a
@@ -28,6 +55,9 @@ def load_songs_in_kern(dataset_path):
     ----------
     dataset_path : str
         The path to the root directory of the dataset.
+    exclude_paths : iterable of str, optional
+        Directories below dataset_path that are skipped, e.g. the held-out
+        test collection.
 
     Returns
     -------
@@ -37,12 +67,35 @@ def load_songs_in_kern(dataset_path):
     """
 
     # go through all files in dataset and load them using music21
-    songs = []
+    file_paths = []
     for path, subdirs, files in os.walk(dataset_path):
+        # do not descend into excluded directories
+        subdirs[:] = [subdir for subdir in subdirs if not is_inside(os.path.join(path, subdir), exclude_paths)]
         for file in files:
             if file[-3:] == "krn" or file[-8:] == "musicxml":
-                song = m21.converter.parse(os.path.join(path, file))
-                songs.append(song)
+                file_paths.append(os.path.join(path, file))
+    return load_songs_from_paths(file_paths)
+
+
+def load_songs_from_paths(file_paths):
+    """
+    Loads the given song files using music21.
+
+    Parameters
+    ----------
+    file_paths : list of str
+        The paths of the files to load, e.g. as selected from the corpus
+        catalog.
+
+    Returns
+    -------
+    songs : list of music21.stream.Score
+        A list of music21.stream.Score objects, one per file.
+    """
+    songs = []
+    for file_path in file_paths:
+        song = m21.converter.parse(file_path)
+        songs.append(song)
     return songs
 
 
@@ -109,7 +162,7 @@ def transpose(song):
     return transposed_song
 
 
-def encode(song, time_step=0.25):
+def encode(song, time_step=0.25, encoding="time_series"):
     """
     Encodes a song into a time series representation.
 
@@ -120,12 +173,18 @@ def encode(song, time_step=0.25):
     underscore (for rests). The duration of each note/rest is encoded by
     repeating the symbol for the appropriate number of steps.
 
+    With the "event" encoding every note or rest is a single compound symbol
+    "pitch:steps" instead, e.g. "60:4" for a quarter note C4 and "r:2" for an
+    eighth rest, which makes a song 3-4 times shorter.
+
     Parameters
     ----------
     song : music21.stream.Score
         The song to be encoded.
     time_step : float, optional
         The time step for the time series representation. Defaults to 0.25.
+    encoding : str, optional
+        "time_series" or "event". Defaults to "time_series".
 
     Returns
     -------
@@ -146,6 +205,11 @@ def encode(song, time_step=0.25):
         # convert the note/rest into time series notation
         steps = int(event.duration.quarterLength // time_step)
 
+        # p = 60, d= 1.0 => ["60:4"]
+        if encoding == "event":
+            encoded_song.append(f"{symbol}:{steps}")
+            continue
+
         for step in range(steps):
             if step == 0:
                 encoded_song.append(symbol)
@@ -156,7 +220,8 @@ def encode(song, time_step=0.25):
     return encoded_song
 
 
-def preprocess(dataset_path):
+def preprocess(dataset_path, file_paths=None, save_dir=DATASET_PATH, encoding="time_series", overwrite=False,
+               exclude_paths=(TEST_DATASET_PATH,)):
     """
     Preprocesses a dataset of songs from the specified path.
 
@@ -169,10 +234,31 @@ def preprocess(dataset_path):
     ----------
     dataset_path : str
         The path to the root directory of the dataset containing songs to be processed.
+    file_paths : list of str, optional
+        Only load these files instead of walking dataset_path, e.g. a subset
+        selected with `catalog.select_songs`. Files excluded by the catalog
+        are then never parsed.
+    save_dir : str, optional
+        The directory the encoded songs are saved to. Defaults to DATASET_PATH.
+    encoding : str, optional
+        "time_series" or "event", see `encode`. Defaults to "time_series".
+    overwrite : bool, optional
+        Whether to delete the encoded songs of an earlier run in save_dir.
+        Without it a non-empty save_dir is refused, as `create_single_file_dataset`
+        would train on the old songs together with the new ones.
+    exclude_paths : iterable of str, optional
+        Directories whose songs are never used for training. Defaults to the
+        held-out TEST_DATASET_PATH, which lies inside KERN_DATASET_PATH.
     """
+    clear_save_dir(save_dir, overwrite)
+
     # Load the Folk songs
     print("Song Loading is started")
-    loaded_songs = load_songs_in_kern(dataset_path)
+    if file_paths is None:
+        loaded_songs = load_songs_in_kern(dataset_path, exclude_paths)
+    else:
+        file_paths = [file_path for file_path in file_paths if not is_inside(file_path, exclude_paths)]
+        loaded_songs = load_songs_from_paths(file_paths)
     print(f"Loaded {len(loaded_songs)} songs.")
     print("Encoding process may take some time\nPlease wait!!!")
 
@@ -185,14 +271,47 @@ def preprocess(dataset_path):
         transposed_song = transpose(song)
 
         # Encode songs with music time series representation
-        encoded_song = encode(transposed_song)
+        encoded_song = encode(transposed_song, encoding=encoding)
 
         # Save songs in a text file
-        save_path = os.path.join(DATASET_PATH, str(i))
+        save_path = os.path.join(save_dir, str(i))
         with open(save_path, "w") as f:
             f.write(encoded_song)
 
 
+def clear_save_dir(save_dir, overwrite):
+    """
+    Makes sure save_dir exists and contains no encoded songs.
+
+    Parameters
+    ----------
+    save_dir : str
+        The directory the encoded songs are saved to.
+    overwrite : bool
+        Whether the files of an earlier run may be deleted.
+
+    Raises
+    ------
+    FileExistsError
+        If save_dir contains files and overwrite is False.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    old_files = [
+        os.path.join(save_dir, file) for file in os.listdir(save_dir)
+        if os.path.isfile(os.path.join(save_dir, file))
+    ]
+    if not old_files:
+        return
+    if not overwrite:
+        raise FileExistsError(
+            f"{save_dir} already contains {len(old_files)} encoded songs. "
+            "Choose another directory or overwrite them."
+        )
+    print(f"Deleting {len(old_files)} encoded songs of an earlier run in {save_dir}.")
+    for file_path in old_files:
+        os.remove(file_path)
+
+
 def load_encoded_song(file_path):
     with open(file_path, "r") as file:
         song = file.read()
@@ -241,6 +360,7 @@ def create_mapping(songs, mapping_file_path):
 
     This function identifies the unique vocabulary of symbols (e.g., notes, rests) in the provided
     songs, assigns each symbol a unique integer index, and saves this mapping to a specified JSON file.
+    It works for both encodings, as every symbol is separated by spaces.
 
     Parameters
     ----------
@@ -353,28 +473,263 @@ def generate_training_sequences(full_dataset_file_path, mapping_file_path, seque
     # input dimension = (number of sequences, sequence length) =-> (number of sequences, sequence length, vocabulary size)
     # [[0, 1, 2], [1, 0, 1], [2, 1, 0]] =-> [[[1, 0, 0], [0, 1, 0], [0, 0, 1]], [[0, 1, 0], [1, 0, 0], [0, 1, 0]], [[0, 0, 1], [0, 1, 0], [1, 0, 0]]]
     vocabulary_size = len(set(numeric_songs))
-    input_sequences = np.array(input_sequences, dtype=np.int8)
+    index_dtype = index_dtype_for(vocabulary_size)
+    input_sequences = np.array(input_sequences, dtype=index_dtype)
     inputs = keras.utils.to_categorical(input_sequences, num_classes=vocabulary_size).astype(np.int8)
-    targets = np.array(target_values, dtype=np.int8)
+    targets = np.array(target_values, dtype=index_dtype)
 
     return inputs, targets
 
 
+def index_dtype_for(vocabulary_size):
+    """
+    Returns the smallest integer type that holds the indices of a vocabulary.
+    The event encoding can have more symbols than fit into int8.
+    """
+    return np.int8 if vocabulary_size <= np.iinfo(np.int8).max + 1 else np.int16
+
+
+def load_song_sequences(full_dataset_file_path, mapping_file_path, delimiter=DELIMETER):
+    """
+    Loads the single file dataset and splits it back into separate songs.
+
+    Unlike `generate_training_sequences`, the songs are kept apart so that
+    training windows can be generated within songs only.
+
+    Parameters
+    ----------
+    full_dataset_file_path : str
+        The path to the file containing the sequence of encoded songs.
+    mapping_file_path : str
+        The file path where the mapping of symbols to indices is saved in JSON
+        format.
+    delimiter : str, optional
+        The delimiter that separates the songs in the single file.
+
+    Returns
+    -------
+    songs : list of numpy.ndarray
+        One 1-dimensional array of symbol indices per song, without delimiters.
+    mappings : dict
+        The mapping of symbols to indices.
+    """
+    with open(mapping_file_path, "r") as file:
+        mappings = json.load(file)
+
+    delimiter_symbol = delimiter.strip()
+    index_dtype = index_dtype_for(len(mappings))
+    songs = []
+    current_song = []
+    for symbol in load_encoded_song(full_dataset_file_path).split():
+        if symbol == delimiter_symbol:
+            if current_song:
+                songs.append(np.array(current_song, dtype=index_dtype))
+                current_song = []
+        else:
+            current_song.append(mappings[symbol])
+    if current_song:
+        songs.append(np.array(current_song, dtype=index_dtype))
+
+    return songs, mappings
+
+
+def _bucket_length(length, bucket_boundaries):
+    for boundary in bucket_boundaries:
+        if length <= boundary:
+            return boundary
+    return bucket_boundaries[-1]
+
+
+class SongWindowDataset(keras.utils.PyDataset):
+    """
+    Length-bucketed training batches whose windows never cross song boundaries.
+
+    Every song is framed as `/ song /`, so the model still learns to start a
+    song from the delimiter and to end it by predicting the delimiter. The
+    generator and the evaluation therefore start songs with a single "/"
+    for song-aware models (see `MelodyGenerator` and `encode_test_collection`). For
+    each position t of a framed song the input is the prefix of at most
+    sequence_length symbols before t, and the target is the symbol at t.
+    Windows are grouped by prefix length into buckets; each batch is
+    left-padded with all-zero vectors to its bucket length, which a
+    `keras.layers.Masking` layer skips. Only the integer songs are kept in
+    memory, the one-hot batches are built on the fly.
+    """
+
+    def __init__(self, songs, delimiter_index, vocabulary_size, sequence_length=SEQUENCE_LENGTH,
+                 batch_size=BATCH_SIZE, bucket_boundaries=BUCKET_BOUNDARIES, shuffle=True, **kwargs):
+        """
+        Initializes the SongWindowDataset class.
+
+        Parameters
+        ----------
+        songs : list of numpy.ndarray
+            The songs as returned by `load_song_sequences`.
+        delimiter_index : int
+            The index of the delimiter symbol in the mapping.
+        vocabulary_size : int
+            The number of symbols in the mapping.
+        sequence_length : int, optional
+            The maximum length of an input window.
+        batch_size : int, optional
+            The maximum number of windows in a batch.
+        bucket_boundaries : list of int, optional
+            The ascending padded lengths of the buckets. Prefixes longer than
+            the last boundary are cut to it.
+        shuffle : bool, optional
+            Whether to shuffle the windows at the end of every epoch.
+        """
+        super().__init__(**kwargs)
+        self.vocabulary_size = vocabulary_size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_boundaries = sorted(b for b in bucket_boundaries if b < sequence_length) + [sequence_length]
+        self.sequence_length = sequence_length
+
+        self._index_dtype = index_dtype_for(vocabulary_size)
+        self._sequences = [
+            np.concatenate(([delimiter_index], song, [delimiter_index])).astype(self._index_dtype) for song in songs
+        ]
+
+        # every window is identified by its song and the position of its target
+        self._buckets = {boundary: [] for boundary in self.bucket_boundaries}
+        for song_index, sequence in enumerate(self._sequences):
+            for position in range(1, len(sequence)):
+                length = min(position, sequence_length)
+                self._buckets[_bucket_length(length, self.bucket_boundaries)].append((song_index, position))
+        self._buckets = {
+            boundary: np.array(windows, dtype=np.int32).reshape(-1, 2) for boundary, windows in self._buckets.items()
+        }
+        self.num_windows = sum(len(windows) for windows in self._buckets.values())
+
+        self._make_batches()
+
+    def _make_batches(self):
+        self._batches = []
+        for boundary, windows in self._buckets.items():
+            if self.shuffle:
+                windows = windows[np.random.permutation(len(windows))]
+            for start in range(0, len(windows), self.batch_size):
+                self._batches.append((boundary, windows[start:start + self.batch_size]))
+        if self.shuffle:
+            np.random.shuffle(self._batches)
+
+    def __len__(self):
+        return len(self._batches)
+
+    def __getitem__(self, index):
+        padded_length, windows = self._batches[index]
+        inputs = np.zeros((len(windows), padded_length, self.vocabulary_size), dtype=np.int8)
+        targets = np.empty(len(windows), dtype=self._index_dtype)
+
+        for row, (song_index, position) in enumerate(windows):
+            sequence = self._sequences[song_index]
+            length = min(position, padded_length)
+            prefix = sequence[position - length:position]
+            # left padding keeps the real symbols at the last time steps
+            inputs[row, np.arange(padded_length - length, padded_length), prefix] = 1
+            targets[row] = sequence[position]
+
+        return inputs, targets
+
+    def on_epoch_end(self):
+        self._make_batches()
+
+
+def compare_window_schemes(songs, sequence_length=SEQUENCE_LENGTH, vocabulary_size=None,
+                           bucket_boundaries=BUCKET_BOUNDARIES, batch_size=BATCH_SIZE):
+    """
+    Compares the training windows of the concatenated single file dataset with
+    the song-aware windows of `SongWindowDataset`.
+
+    Parameters
+    ----------
+    songs : list of numpy.ndarray
+        The songs as returned by `load_song_sequences`.
+    sequence_length : int, optional
+        The length of the training windows.
+    vocabulary_size : int, optional
+        The number of symbols in the mapping. Defaults to the number of
+        distinct symbols in the songs plus the delimiter.
+    bucket_boundaries : list of int, optional
+        The padded lengths of the buckets of the song-aware scheme.
+    batch_size : int, optional
+        The maximum number of windows in a batch.
+
+    Returns
+    -------
+    dict
+        The number of windows, the windows that contain delimiter padding or
+        span two songs, the one-hot bytes and the time steps per epoch of both
+        schemes.
+    """
+    if vocabulary_size is None:
+        vocabulary_size = len(set(np.concatenate(songs).tolist())) + 1
+    boundaries = sorted(b for b in bucket_boundaries if b < sequence_length) + [sequence_length]
+    song_lengths = np.array([len(song) for song in songs])
+
+    # the single file dataset is every song followed by sequence_length delimiters
+    concatenated_length = int(song_lengths.sum()) + len(songs) * sequence_length
+    concatenated_windows = concatenated_length - sequence_length
+    clean_windows = int(np.maximum(song_lengths - sequence_length, 0).sum())
+    concatenated_bytes = concatenated_windows * (sequence_length * vocabulary_size + 1)
+
+    # song-aware: one window per symbol of `song /`, padded to its bucket
+    song_aware_windows = int((song_lengths + 1).sum())
+    bucket_counts = dict.fromkeys(boundaries, 0)
+    for song_length in song_lengths:
+        for position in range(1, song_length + 2):
+            bucket_counts[_bucket_length(min(position, sequence_length), boundaries)] += 1
+    song_aware_steps = sum(boundary * count for boundary, count in bucket_counts.items())
+    song_aware_bytes = song_aware_steps * vocabulary_size + song_aware_windows
+    # only the integer songs stay in memory, plus the largest batch being built
+    song_aware_resident_bytes = int((song_lengths + 2).sum()) + batch_size * (sequence_length * vocabulary_size + 1)
+
+    report = {
+        "concatenated_windows": concatenated_windows,
+        "concatenated_padding_windows": concatenated_windows - clean_windows,
+        "concatenated_steps": concatenated_windows * sequence_length,
+        "concatenated_bytes": concatenated_bytes,
+        "song_aware_windows": song_aware_windows,
+        "song_aware_steps": song_aware_steps,
+        "song_aware_bytes": song_aware_bytes,
+        "song_aware_resident_bytes": song_aware_resident_bytes,
+        "windows_saved": concatenated_windows - song_aware_windows,
+        "bytes_saved": concatenated_bytes - song_aware_resident_bytes,
+    }
+
+    print(f"Concatenated scheme: {concatenated_windows} windows "
+          f"({report['concatenated_padding_windows']} contain delimiter padding or span two songs), "
+          f"{concatenated_bytes} bytes of one-hot inputs.")
+    print(f"Song-aware scheme: {song_aware_windows} windows, {song_aware_bytes} bytes built per epoch, "
+          f"{song_aware_resident_bytes} bytes resident.")
+    print(f"Saved {report['windows_saved']} windows, "
+          f"{report['concatenated_steps'] - song_aware_steps} LSTM time steps per epoch "
+          f"and {report['bytes_saved']} bytes of memory.")
+
+    return report
+
+
 def main():
-    preprocess(KERN_DATASET_PATH)
-    songs = create_single_file_dataset(DATASET_PATH, FILE_DATASET_PATH, DELIMETER, SEQUENCE_LENGTH)
+    settings = ENCODING_SETTINGS[ENCODING]
+    preprocess(KERN_DATASET_PATH, save_dir=settings["dataset_path"], encoding=ENCODING, overwrite=True)
+    songs = create_single_file_dataset(
+        settings["dataset_path"], settings["file_dataset_path"], DELIMETER, settings["sequence_length"]
+    )
     print(len(songs))
-    create_mapping(songs, MAPPING_PATH)
-    inputs, targets = generate_training_sequences(FILE_DATASET_PATH, MAPPING_PATH, SEQUENCE_LENGTH)
+    create_mapping(songs, settings["mapping_path"])
+    inputs, targets = generate_training_sequences(
+        settings["file_dataset_path"], settings["mapping_path"], settings["sequence_length"]
+    )
     print(type(inputs), type(targets))
     print(inputs.shape, targets.shape)
     # print memory size of inputs and targets
     print(inputs.nbytes, targets.nbytes)
     # We have shortage of memory, so we will save the inputs and targets to the disk
-    with open("songs_inputs.pkl", "wb") as f:
+    with open(settings["inputs_path"], "wb") as f:
         pickle.dump(inputs, f)
 
-    with open("songs_targets.pkl", "wb") as f:
+    with open(settings["targets_path"], "wb") as f:
         pickle.dump(targets, f)
 
 
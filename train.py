@@ -1,24 +1,58 @@
 import os
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
+import json
 import pickle
 import keras
-from configurations import SEQUENCE_LENGTH, \
-        OUTPUT_UNITS, \
+from configurations import OUTPUT_UNITS, \
         NUM_UNITS, LOSS, \
         LEARNING_RATE, \
         NUM_EPOCHS, \
         BATCH_SIZE, \
-        SAVE_MODEL_PATH
-
-def load_generated_sequences():
-    with open("songs_inputs.pkl", "rb") as f:
+        SONG_AWARE_TRAINING, \
+        BUCKET_BOUNDARIES, \
+        DELIMETER, \
+        EVALUATE_EACH_EPOCH, \
+        ENCODING, \
+        ENCODING_SETTINGS
+from preprocess import load_song_sequences, SongWindowDataset, compare_window_schemes
+from evaluate import EvaluationCallback
+
+def load_generated_sequences(encoding=ENCODING):
+    settings = ENCODING_SETTINGS[encoding]
+    with open(settings["inputs_path"], "rb") as f:
         inputs = pickle.load(f)
         
-    with open("songs_targets.pkl", "rb") as f:
+    with open(settings["targets_path"], "rb") as f:
         targets = pickle.load(f)
     return inputs, targets
 
-def build_model(output_units, num_units, loss_function, learning_rate):
+def load_song_aware_dataset(encoding=ENCODING):
+    """
+    Loads the songs of the single file dataset as length-bucketed batches
+    whose windows stay within a song, and reports how much the song-aware
+    scheme saves compared with the concatenated windows.
+
+    Parameters
+    ----------
+    encoding : str, optional
+        "time_series" or "event", selects the dataset files and window length.
+
+    Returns
+    -------
+    SongWindowDataset
+        The training batches.
+    """
+    settings = ENCODING_SETTINGS[encoding]
+    sequence_length = settings["sequence_length"]
+    songs, mappings = load_song_sequences(settings["file_dataset_path"], settings["mapping_path"])
+    compare_window_schemes(songs, sequence_length, len(mappings), BUCKET_BOUNDARIES, BATCH_SIZE)
+    return SongWindowDataset(
+        songs, mappings[DELIMETER.strip()], len(mappings),
+        sequence_length=sequence_length, batch_size=BATCH_SIZE, bucket_boundaries=BUCKET_BOUNDARIES
+    )
+
+
+def build_model(output_units, num_units, loss_function, learning_rate, mask_padding=False):
     """
     Builds a model with the specified architecture and compiles it with the
     specified loss function and optimizer.
@@ -33,6 +67,9 @@ def build_model(output_units, num_units, loss_function, learning_rate):
         The name of the loss function to use.
     learning_rate : float
         The learning rate of the optimizer.
+    mask_padding : bool, optional
+        Whether all-zero input steps are padding that the LSTM should skip.
+        Required for the padded batches of `SongWindowDataset`.
 
     Returns
     -------
@@ -43,7 +80,11 @@ def build_model(output_units, num_units, loss_function, learning_rate):
     # create model architecture
     input_layer = keras.layers.Input(shape=(None, output_units))
 
-    x = keras.layers.LSTM(num_units[0])(input_layer)
+    x = input_layer
+    if mask_padding:
+        x = keras.layers.Masking(mask_value=0)(x)
+
+    x = keras.layers.LSTM(num_units[0])(x)
     x = keras.layers.Dropout(0.2)(x)
 
     output_layer = keras.layers.Dense(output_units, activation="softmax")(x)
@@ -61,7 +102,9 @@ def build_model(output_units, num_units, loss_function, learning_rate):
 
 def train_model(
         output_units=OUTPUT_UNITS, num_units=NUM_UNITS, 
-        loss_function=LOSS, learning_rate=LEARNING_RATE):
+        loss_function=LOSS, learning_rate=LEARNING_RATE,
+        song_aware=SONG_AWARE_TRAINING, evaluate_each_epoch=EVALUATE_EACH_EPOCH,
+        encoding=ENCODING):
 
     """
     Trains a model using the generated sequences.
@@ -76,22 +119,48 @@ def train_model(
         The name of the loss function to use.
     learning_rate : float
         The learning rate of the optimizer.
+    song_aware : bool, optional
+        Whether to train on song-aware, length-bucketed batches instead of
+        the pickled windows of the concatenated dataset.
+    evaluate_each_epoch : bool, optional
+        Whether to report the metrics on the held-out test collection after
+        every epoch.
+    encoding : str, optional
+        "time_series" or "event". The event model has one output unit per
+        symbol of the event mapping, so output_units is taken from it.
 
     Returns
     -------
     None
     """
-    # get generated sequences
-    inputs, targets = load_generated_sequences()
-
-    # create model
-    model = build_model(output_units, num_units, loss_function, learning_rate)
-
-    # train model
-    model.fit(inputs, targets, epochs=NUM_EPOCHS, batch_size=BATCH_SIZE)
+    settings = ENCODING_SETTINGS[encoding]
+    if encoding != "time_series":
+        with open(settings["mapping_path"], "r") as mapping_file:
+            output_units = len(json.load(mapping_file))
+
+    callbacks = []
+    if evaluate_each_epoch:
+        callbacks.append(EvaluationCallback(
+            mapping_file_path=settings["mapping_path"], sequence_length=settings["sequence_length"], encoding=encoding,
+            song_aware=song_aware
+        ))
+
+    if song_aware:
+        dataset = load_song_aware_dataset(encoding)
+        model = build_model(output_units, num_units, loss_function, learning_rate, mask_padding=True)
+        model.fit(dataset, epochs=NUM_EPOCHS, callbacks=callbacks)
+    else:
+        # get generated sequences
+        inputs, targets = load_generated_sequences(encoding)
+
+        # create model
+        model = build_model(output_units, num_units, loss_function, learning_rate)
+
+        # train model
+        model.fit(inputs, targets, epochs=NUM_EPOCHS, batch_size=BATCH_SIZE, callbacks=callbacks)
 
     # save model
-    model.save(SAVE_MODEL_PATH)
+    model.save(settings["model_path"])
 
 
 if __name__ == "__main__":